@@ -15,6 +15,7 @@ UI: Tkinter (login CUIT, clave, CUIT target, tax type, dates + Start button)
 """
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
@@ -22,12 +23,17 @@ import re
 import shutil
 import tempfile
 import threading
+import time
+import traceback
 import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from dataclasses import dataclass, asdict
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Optional, Tuple, List
-from urllib.parse import urljoin
+from typing import Dict, Optional, Tuple, List
+from urllib.parse import urljoin, urlsplit, urlunsplit
 
 import tkinter as tk
 from tkinter import ttk, messagebox
@@ -35,6 +41,11 @@ from tkinter import ttk, messagebox
 from playwright.async_api import async_playwright, TimeoutError
 from playwright.async_api import TimeoutError as PWTimeout
 
+try:  # Optional: faster event loop for the Playwright driver traffic (not available on Windows)
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +58,7 @@ def sanitize_secrets(message: str, clave: str) -> str:
 # ---------------- Config ---------------- #
 
 LOGIN_URL = "https://auth.afip.gob.ar/contribuyente_/login.xhtml"
+PORTAL_URL = "https://portalcf.cloud.afip.gob.ar/portal/app/"
 
 # Selector for the MIS RETENCIONES tile in the AFIP "portal" after login
 MR_TILE_SELECTORS = [
@@ -54,12 +66,101 @@ MR_TILE_SELECTORS = [
     "h3.roboto-font.bold.h5:has-text('MIS RETENCIONES')",
     "a:has(h3:has-text('MIS RETENCIONES'))",
 ]
+# All tile candidates OR-ed together so a single wait covers every variant
+MR_TILE_SELECTOR_COMBINED = ", ".join(MR_TILE_SELECTORS)
+
+# Link that expands the full service list when the tile is not on the portal home
+VER_TODOS_SELECTOR = "a:has-text('Ver todos'), a[href*='mis-servicios']"
+
+# Impuesto combobox: present whenever the "Nueva consulta" form is rendered
+FORM_READY_SELECTOR = "#selectImpuestos"
+# SPA shell is up: either the form or the user menu in the navbar
+USER_MENU_SELECTOR = "#e-navbar-dropdown-toggle"
+SERVICE_READY_SELECTOR = f"{FORM_READY_SELECTOR}, {USER_MENU_SELECTOR}"
+
+# MIS RETENCIONES controls (stable ids, resolved by the CSS engine's id fast path)
+FECHA_DESDE_INPUT_SELECTOR = "#datePickerFechasRetencionesDesde__input"
+FECHA_HASTA_INPUT_SELECTOR = "#datePickerFechasRetencionesHasta__input"
+CONSULTAR_BTN_SELECTOR = "#btnConsultarRetenciones"
+NUEVA_BUSQUEDA_BTN_SELECTOR = "#btnNuevaBusqueda"
+EXPORT_BTN_SELECTOR = "#btnExportarOtrosFormatos"
+REFRESH_GRID_BTN_SELECTOR = "#btnRecargarTablaAplicativo"
+NUEVA_CONSULTA_TAB_SELECTOR = "button#tabNuevaConsulta-tab, button[aria-controls='tabNuevaConsulta']"
+EXPORTADAS_TAB_SELECTOR = "button#tabConsultasExportdas-tab, button[aria-controls='tabConsultasExportdas']"
+# AG Grid body of "Consultas exportadas"
+EXPORTS_GRID_SELECTOR = ".ag-center-cols-container"
+# Newest export (row 0): once it is painted the grid is usable
+EXPORTS_FIRST_ROW_SELECTOR = f"{EXPORTS_GRID_SELECTOR} .ag-row[row-index='0']"
+# Seconds between "Consultas exportadas" refreshes while an export is pending (last value repeats)
+EXPORT_REFRESH_BACKOFF = (1, 2, 4, 8, 16, 30)
+
+# XHR fired by the ".CSV" export option; its JSON response carries the export id
+# (the same "pid" used in /api/mirequabusiness/exportar-aplicativo/descarga?pid=...)
+EXPORT_API_RE = re.compile(r"/api/mirequabusiness/exportar")
+EXPORT_PID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}", re.IGNORECASE)
+# Same endpoint the grid's download anchor points at (relative to the MIS RETENCIONES origin)
+EXPORT_DOWNLOAD_PATH = "/api/mirequabusiness/exportar-aplicativo/descarga"
 
 # Files / folders
 SCRIPT_PATH = Path(__file__).resolve()
 SCRIPT_DIR = SCRIPT_PATH.parent
 OUTPUT_DIR = Path.home() / "Downloads" / SCRIPT_PATH.stem
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+# Playwright's download staging dir, on the same volume so saving a CSV is a rename
+DOWNLOADS_TMP_DIR = OUTPUT_DIR / ".pw_downloads"
+
+# Persistent Chromium profiles, one per login CUIT, so the HTTP cache survives between runs
+PROFILES_DIR = Path.home() / ".studioai" / "profiles"
+PROFILES_KEEP = 5  # Most recently used profiles kept on disk
+PROFILES_MAX_AGE = timedelta(days=30)  # Profiles unused for longer are deleted
+
+# Saved AFIP session (cookies + local storage) per login CUIT, reused while still fresh
+STATE_DIR = Path.home() / ".studioai" / "state"
+SESSION_MAX_AGE = timedelta(minutes=30)
+
+# MIS RETENCIONES entry URL, learned the first time the service opens from the portal tile
+# (the tile has no href, it is a JS handler, so the URL cannot be hardcoded).
+# A learned URL that stops opening the service is kept as "!<url>": not used, not re-learned.
+MR_SERVICE_URL_FILE = Path.home() / ".studioai" / "mis_retenciones_url.txt"
+
+# Minimum seconds between two checkpoint writes of a running batch (see CheckpointWriter)
+CHECKPOINT_MIN_INTERVAL = 2.0
+# Seconds the GUI reuses its last find_latest_checkpoint() result
+CHECKPOINT_CACHE_TTL = 2.0
+# Interrupted sessions started longer ago than this are not offered for resume
+CHECKPOINT_STALE_HOURS = 24
+
+# Tabs working on different tax types at the same time during a batch
+# (exports stay one at a time, see _process_single_operation)
+BATCH_CONCURRENCY = 3
+
+# Chromium flags: 100 MB disk cache for AFIP static assets
+BROWSER_ARGS = ["--disk-cache-size=104857600"]
+# Extra flags for headless runs, where nothing is painted on screen
+HEADLESS_ARGS = ["--disable-gpu", "--disable-dev-shm-usage"]
+
+# Run without a visible window when STUDIOAI_HEADLESS=1 (unattended runs)
+HEADLESS_DEFAULT = os.environ.get("STUDIOAI_HEADLESS", "").lower() in ("1", "true", "yes")
+
+# GUI log: workers append to a deque, Tk flushes it every LOG_DRAIN_MS in one insert
+# (at most LOG_DRAIN_MAX lines per tick so a burst never freezes the window)
+LOG_DRAIN_MS = 50
+LOG_DRAIN_MAX = 100
+
+# AFIP's layout is responsive; 1280x720 is half the raster work of 1920x1080
+VIEWPORT = {"width": 1280, "height": 720}
+
+# Requests aborted by the context router: nothing the scraper reads depends on them
+# (CSS and JS are always let through, AFIP's buttons need both)
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+ANALYTICS_URL_RE = re.compile(r"(google-analytics|googletagmanager|hotjar|doubleclick)")
+# Only URLs matching this reach the Python route handler; CSS/JS/XHR/documents are never
+# intercepted, so they pay no extra driver round trip
+BLOCKED_URL_RE = re.compile(
+    r"\.(png|jpe?g|gif|svg|webp|ico|bmp|woff2?|ttf|otf|eot|mp4|webm|mp3|wav)(\?|$)"
+    r"|google-analytics|googletagmanager|hotjar|doubleclick",
+    re.IGNORECASE,
+)
 
 # ---------------- Tax Types Configuration ---------------- #
 
@@ -99,20 +200,60 @@ TAX_TYPES = [
 
 # Create a lookup dict
 TAX_TYPES_DICT = {tax.code: tax for tax in TAX_TYPES}
+ALL_TAX_CODES = frozenset(TAX_TYPES_DICT)
+
+# Tax types grouped by category, in TAX_TYPES order (built once for the GUI dropdown)
+TAX_TYPES_BY_CATEGORY: Dict[str, List[TaxTypeConfig]] = {}
+for _tax in TAX_TYPES:
+    TAX_TYPES_BY_CATEGORY.setdefault(_tax.category, []).append(_tax)
+del _tax
+
+# GUI dropdown label → tax code, in dropdown order (the keys are the combobox values)
+_TAX_BY_DISPLAY: Dict[str, str] = {
+    f"{tax.name} [{category}]": tax.code
+    for category, taxes in TAX_TYPES_BY_CATEGORY.items()
+    for tax in taxes
+}
+
+# Consultas to run per operation_mode: (radio value or None, display name)
+# Radio values: "1" (Retención), "2" (Percepción), "0" (Retención y percepción)
+OPERATIONS_BY_MODE = {
+    "retencion": [("1", "Retención")],
+    "percepcion": [("2", "Percepción")],
+    "ambas": [("0", "Retención y percepción")],
+    # Do 2 separate queries: first retención, then percepción
+    "ambas_separadas": [("1", "Retención"), ("2", "Percepción")],
+    # No operation type field for aduaneras
+    "fecha_solo": [(None, "Solo fecha")],
+}
 
 # ---------------- Helpers ---------------- #
 
 DATE_FMT = "%d/%m/%Y"
-CUIT_RE = re.compile(r"^\d{11}$")
-
+TS_FMT = "%Y-%m-%d %H:%M:%S"
+
+# v-calendar title month names -> month number (English/Spanish, plus English short form)
+_MONTH_NAMES_EN = ("January", "February", "March", "April", "May", "June",
+                   "July", "August", "September", "October", "November", "December")
+_MONTH_NAMES_ES = ("Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+                   "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre")
+MONTH_MAP = {
+    name: i
+    for i, (en, es) in enumerate(zip(_MONTH_NAMES_EN, _MONTH_NAMES_ES), 1)
+    for name in (en.lower(), es.lower(), en[:3].lower())
+}
+CUIT_RE = re.compile(r"[0-9]{11}")
+_YEAR_RE = re.compile(r"\b(20\d{2})\b")
+_MONTH_NUM_RE = re.compile(r"\b(0?[1-9]|1[0-2])\b")
+_COEF = (5, 4, 3, 2, 7, 6, 5, 4, 3, 2)
+
+@lru_cache(maxsize=1024)
 def validar_cuit(cuit: str) -> bool:
     """Valida CUIT argentino incluyendo dígito verificador."""
-    if not CUIT_RE.match(cuit):
+    if not CUIT_RE.fullmatch(cuit):
         return False
 
-    coef = [5, 4, 3, 2, 7, 6, 5, 4, 3, 2]
-    digitos = [int(d) for d in cuit[:10]]
-    suma = sum(d * c for d, c in zip(digitos, coef))
+    suma = sum((ord(cuit[i]) - 48) * _COEF[i] for i in range(10))
 
     verificador = 11 - (suma % 11)
     if verificador == 11:
@@ -120,7 +261,7 @@ def validar_cuit(cuit: str) -> bool:
     elif verificador == 10:
         verificador = 9
 
-    return verificador == int(cuit[10])
+    return verificador == ord(cuit[10]) - 48
 
 def validar_rango_fecha(fecha_desde: str, fecha_hasta: str) -> Tuple[bool, str]:
     """
@@ -128,10 +269,10 @@ def validar_rango_fecha(fecha_desde: str, fecha_hasta: str) -> Tuple[bool, str]:
     Retorna (es_valido, mensaje_error)
     """
     try:
-        desde = datetime.strptime(fecha_desde, DATE_FMT)
-        hasta = datetime.strptime(fecha_hasta, DATE_FMT)
+        desde_ord = datetime.strptime(fecha_desde, DATE_FMT).toordinal()
+        hasta_ord = datetime.strptime(fecha_hasta, DATE_FMT).toordinal()
 
-        if desde > hasta:
+        if desde_ord > hasta_ord:
             return False, "La fecha 'desde' no puede ser posterior a la fecha 'hasta'"
 
         return True, ""
@@ -139,7 +280,7 @@ def validar_rango_fecha(fecha_desde: str, fecha_hasta: str) -> Tuple[bool, str]:
         return False, "Formato de fecha inválido. Use dd/mm/yyyy"
 
 def now_ts() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return datetime.now().strftime(TS_FMT)
 
 def convert_date_format_for_calendar(date_str: str) -> str:
     """Convert date from dd/mm/yyyy (UI format) to yyyy-mm-dd (Calendar ID format).
@@ -166,10 +307,55 @@ def convert_date_format_for_calendar(date_str: str) -> str:
         logger.warning(f"Error converting date format '{date_str}': {e}. Returning original.")
         return date_str
 
+def _parse_calendar_title(title_text: str) -> Tuple[int, int]:
+    """Parse the v-calendar title ("January 2024", "Enero de 2024") into (year, month)."""
+    year_match = _YEAR_RE.search(title_text)
+    if not year_match:
+        raise ValueError(f"Cannot parse year from title: {title_text}")
+    year = int(year_match.group(1))
+
+    title_lower = title_text.lower()
+    for month_name, month_num in MONTH_MAP.items():
+        if month_name in title_lower:
+            return year, month_num
+
+    # Intentar con regex para número de mes (si está en formato MM/YYYY)
+    month_match = _MONTH_NUM_RE.search(title_text)
+    if month_match:
+        return year, int(month_match.group(1))
+    raise ValueError(f"Cannot parse month from title: {title_text}")
+
+async def _read_calendar_title(page) -> str:
+    """Read the v-calendar title in one round trip ('' while the calendar is not rendered)."""
+    return await page.evaluate("() => document.querySelector('.vc-title')?.textContent ?? ''")
+
+async def _jump_calendar_years(page, current_year: int, years: int, on_log=print):
+    """Move v-calendar by whole years with its keyboard shortcut (Alt+PageUp / Alt+PageDown).
+
+    The shortcut moves the focused day, so a day of the shown month is focused first.
+    Returns once the title shows the final year, not after the first re-render.
+    """
+    key = "Alt+PageDown" if years > 0 else "Alt+PageUp"
+    on_log(f"  [DEBUG] Saltando {abs(years)} año(s) con {key}...")
+    await page.locator(".vc-day.in-month .vc-day-content").first.focus()
+    for _ in range(abs(years)):
+        await page.keyboard.press(key)
+
+    await page.wait_for_function(
+        """year => {
+            const t = document.querySelector('.vc-title');
+            const m = t && t.textContent.match(/\\b(20\\d{2})\\b/);
+            return !!m && Number(m[1]) === year;
+        }""",
+        arg=current_year + years,
+        timeout=1000 + 500 * abs(years)
+    )
+
 async def navigate_calendar_to_date_with_arrows(page, target_year: int, target_month: int, on_log=print):
-    """Navigate v-calendar to target year/month using arrow buttons ONLY.
+    """Navigate v-calendar to target year/month.
 
-    Does NOT click on title - only uses left/right arrows.
+    Whole years are jumped with the keyboard first; the remaining months (at most 11)
+    use the left/right arrows. Does NOT click on title.
 
     Args:
         page: Playwright page
@@ -177,61 +363,35 @@ async def navigate_calendar_to_date_with_arrows(page, target_year: int, target_m
         target_month: Target month (1-12)
         on_log: Logging function
     """
-    max_attempts = 36  # Max 36 months (3 years)
+    max_attempts = 36  # Max 36 months (3 years) when the start month cannot be read
     attempts = 0
 
-    month_names_en = ["January", "February", "March", "April", "May", "June",
-                      "July", "August", "September", "October", "November", "December"]
-    month_names_es = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
-                      "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-
-    # Create mapping for both languages
-    month_map = {}
-    for i, (en, es) in enumerate(zip(month_names_en, month_names_es), 1):
-        month_map[en.lower()] = i
-        month_map[es.lower()] = i
-        month_map[en[:3].lower()] = i  # Short form: Jan, Feb, etc.
+    # Year jump: if it fails for any reason, the arrow loop below still gets there
+    try:
+        title_text = await _read_calendar_title(page)
+        current_year, current_month = _parse_calendar_title(title_text)
+        delta_months = (target_year * 12 + target_month) - (current_year * 12 + current_month)
+        # Enough arrow steps for the whole distance, in case the jump fails midway
+        max_attempts = abs(delta_months) + 3
+        years = int(delta_months / 12)  # Truncated toward zero: never overshoots
+        if years:
+            await _jump_calendar_years(page, current_year, years, on_log=on_log)
+    except Exception as e:
+        on_log(f"  [DEBUG] Salto por año no disponible ({e}); navegando con flechas")
 
     while attempts < max_attempts:
         attempts += 1
 
         try:
             # Get current calendar month/year from title (READ ONLY - DO NOT CLICK)
-            title_selector = '.vc-title'
-            title_element = page.locator(title_selector).first
-
-            # Wait for title to be visible
-            await title_element.wait_for(state="visible", timeout=3000)
-            title_text = await title_element.text_content(timeout=3000)
+            title_text = await _read_calendar_title(page)
+            if not title_text:
+                raise ValueError("Título del calendario no visible todavía")
 
             on_log(f"  [DEBUG] Intento {attempts}: Calendario mostrando '{title_text}'")
 
-            # Parse year from title (format: "Month YYYY" or "Month de YYYY")
-            import re
-            year_match = re.search(r'\b(20\d{2})\b', title_text)
-            if not year_match:
-                on_log(f"  [ERROR] No se pudo extraer año del título: '{title_text}'")
-                raise ValueError(f"Cannot parse year from title: {title_text}")
-
-            current_year = int(year_match.group(1))
-
-            # Parse month from title
-            title_lower = title_text.lower()
-            current_month = None
-
-            for month_name, month_num in month_map.items():
-                if month_name in title_lower:
-                    current_month = month_num
-                    break
-
-            if current_month is None:
-                on_log(f"  [ERROR] No se pudo extraer mes del título: '{title_text}'")
-                # Intentar con regex para número de mes (si está en formato MM/YYYY)
-                month_match = re.search(r'\b(0?[1-9]|1[0-2])\b', title_text)
-                if month_match:
-                    current_month = int(month_match.group(1))
-                else:
-                    raise ValueError(f"Cannot parse month from title: {title_text}")
+            # Parse year/month from title (format: "Month YYYY" or "Month de YYYY")
+            current_year, current_month = _parse_calendar_title(title_text)
 
             on_log(f"  [DEBUG] Fecha actual del calendario: {current_month}/{current_year}")
             on_log(f"  [DEBUG] Fecha objetivo: {target_month}/{target_year}")
@@ -258,11 +418,14 @@ async def navigate_calendar_to_date_with_arrows(page, target_year: int, target_m
 
             # Click the arrow button
             arrow = page.locator(arrow_selector).first
-            await arrow.wait_for(state="visible", timeout=3000)
-            await arrow.click()
+            await arrow.click(timeout=3000)
 
-            # Wait for calendar to update
-            await asyncio.sleep(0.6)  # Slightly longer wait for animation
+            # Wait for the title to change instead of a fixed animation delay
+            await page.wait_for_function(
+                "prev => { const t = document.querySelector('.vc-title'); return t && t.textContent !== prev; }",
+                arg=title_text,
+                timeout=3000
+            )
 
         except Exception as e:
             on_log(f"  [ERROR] Error en intento {attempts}: {e}")
@@ -275,6 +438,12 @@ async def navigate_calendar_to_date_with_arrows(page, target_year: int, target_m
 
     raise TimeoutError(f"No se pudo navegar al mes objetivo después de {max_attempts} intentos")
 
+def new_event_loop() -> asyncio.AbstractEventLoop:
+    """Create uvloop's event loop when installed, asyncio's default otherwise."""
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
 # ---------------- Checkpoint System ---------------- #
 
 @dataclass
@@ -287,7 +456,7 @@ class BatchProgress:
     fecha_hasta: str
     started_at: str
     completed_tax_codes: List[str]
-    current_tax_code: Optional[str]
+    in_flight_tax_codes: List[str]  # Tax types being processed right now (several in parallel)
     all_downloaded_files: List[str]
     status: str  # "in_progress", "completed", "error"
     last_updated: str
@@ -296,13 +465,182 @@ def get_checkpoint_path(session_id: str) -> Path:
     """Get the path to the checkpoint file."""
     return OUTPUT_DIR / f"checkpoint_{session_id}.json"
 
-def save_checkpoint(progress: BatchProgress) -> None:
-    """Save progress to JSON checkpoint file."""
+def get_checkpoint_journal_path(session_id: str) -> Path:
+    """Get the path to the append-only journal of changes since the last full checkpoint."""
+    return OUTPUT_DIR / f"checkpoint_{session_id}.jsonl"
+
+# session_id -> {"status", "mtime"} for every checkpoint, so startup reads one file instead of all
+CHECKPOINT_INDEX_PATH = OUTPUT_DIR / "checkpoint_index.json"
+
+def _write_json_atomic(path: Path, data) -> None:
+    """Write JSON to a temp file next to `path` and rename it over: a crash never leaves a half-written file."""
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f"{path.stem}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+            # On disk before the rename, so a crash can't leave an empty file under `path`
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# In-memory copy of the index: this process is its only writer, so it is read from disk once
+_checkpoint_index: Optional[Dict[str, dict]] = None
+
+def _load_checkpoint_index() -> Optional[dict]:
+    """Return the checkpoint index, or None if it does not exist yet (or is unreadable)."""
+    global _checkpoint_index
+    if _checkpoint_index is None:
+        try:
+            with open(CHECKPOINT_INDEX_PATH, 'r', encoding='utf-8') as f:
+                _checkpoint_index = json.load(f)
+        except (OSError, ValueError):
+            return None
+    return _checkpoint_index
+
+def _update_checkpoint_index(progress: BatchProgress, mtime: float) -> None:
+    global _checkpoint_index
+    # Runs on CheckpointWriter's worker thread while the GUI may be reading the index:
+    # build a new dict and swap the reference instead of mutating the shared one
+    index = dict(_load_checkpoint_index() or {})
+    index[progress.session_id] = {"status": progress.status, "mtime": mtime}
+    _checkpoint_index = index
+    try:
+        _write_json_atomic(CHECKPOINT_INDEX_PATH, index)
+    except OSError as e:
+        logger.warning(f"No se pudo actualizar el índice de checkpoints: {e}")
+
+def _checkpoint_state(progress: BatchProgress) -> tuple:
+    # The lists only ever grow during a batch, so their lengths tell what was already written
+    return (len(progress.completed_tax_codes), len(progress.all_downloaded_files),
+            tuple(progress.in_flight_tax_codes), progress.status)
+
+# session_id -> (state written, journal lines since the last full write), so unchanged saves are skipped
+_checkpoint_persisted: Dict[str, Tuple[tuple, int]] = {}
+
+# save_checkpoint runs in worker threads: a final save must not interleave with the writer's
+_checkpoint_lock = threading.Lock()
+
+def save_checkpoint(progress: BatchProgress, compact: bool = False) -> None:
+    """Save progress, only if it changed.
+
+    The first save of a session in this process (and every `compact` save) writes the
+    full JSON atomically and drops the journal; the others append one delta line to it.
+    Appends are only fsynced when the status changes (batch boundaries).
+    """
+    with _checkpoint_lock:
+        _save_checkpoint(progress, compact)
+
+def _save_checkpoint(progress: BatchProgress, compact: bool) -> None:
+    session_id = progress.session_id
+    state = _checkpoint_state(progress)
+    persisted = _checkpoint_persisted.get(session_id)
+    if persisted is not None and persisted[0] == state and not (compact and persisted[1]):
+        return
+
     progress.last_updated = now_ts()
-    checkpoint_path = get_checkpoint_path(progress.session_id)
+    journal_path = get_checkpoint_journal_path(session_id)
+    if persisted is None or compact:
+        _write_json_atomic(get_checkpoint_path(session_id), asdict(progress))
+        journal_path.unlink(missing_ok=True)
+        _checkpoint_persisted[session_id] = (state, 0)
+    else:
+        (completed_count, files_count, _, _), journal_lines = persisted
+        record = {
+            "completed": progress.completed_tax_codes[completed_count:state[0]],
+            "files": progress.all_downloaded_files[files_count:state[1]],
+            "in_flight": list(progress.in_flight_tax_codes),
+            "status": progress.status,
+            "ts": progress.last_updated,
+        }
+        with open(journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, separators=(",", ":"), ensure_ascii=False) + "\n")
+            if persisted[0][3] != progress.status:
+                f.flush()
+                os.fsync(f.fileno())
+        _checkpoint_persisted[session_id] = (state, journal_lines + 1)
+
+    if persisted is None or persisted[0][3] != progress.status:
+        _update_checkpoint_index(progress, time.time())  # Just written: no stat() needed
+
+def _apply_checkpoint_journal(progress: BatchProgress) -> None:
+    """Fold the session journal (if any) into `progress`, in write order."""
+    try:
+        with open(get_checkpoint_journal_path(progress.session_id), 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+    except OSError:
+        return
 
-    with open(checkpoint_path, 'w', encoding='utf-8') as f:
-        json.dump(asdict(progress), f, indent=2, ensure_ascii=False)
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue  # Torn last line after a crash
+        # A crash between the full write and the journal removal leaves entries twice
+        for code in record["completed"]:
+            if code not in progress.completed_tax_codes:
+                progress.completed_tax_codes.append(code)
+        for file_path in record["files"]:
+            if file_path not in progress.all_downloaded_files:
+                progress.all_downloaded_files.append(file_path)
+        progress.in_flight_tax_codes = record["in_flight"]
+        progress.status = record["status"]
+        progress.last_updated = record["ts"]
+
+class CheckpointWriter:
+    """Coalesce the checkpoint saves of a running batch.
+
+    schedule() returns at once; a single background task writes the latest state in a
+    worker thread, at most once per `interval` seconds (as journal appends). flush()
+    writes what is pending right away, compacts the journal into the full JSON and
+    stops the task (terminal states).
+    """
+
+    def __init__(self, progress: BatchProgress, interval: float = CHECKPOINT_MIN_INTERVAL):
+        self._progress = progress
+        self._interval = interval
+        self._dirty = asyncio.Event()
+        self._wake = asyncio.Event()
+        self._closed = False
+        self._task: Optional[asyncio.Task] = None
+
+    def schedule(self) -> None:
+        """Mark the progress as changed; it is written within `interval` seconds."""
+        self._dirty.set()
+        if self._task is None and not self._closed:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def flush(self) -> None:
+        """Write the current progress now and stop the background task."""
+        self._closed = True
+        if self._task is None:
+            await asyncio.to_thread(save_checkpoint, self._progress, True)
+            return
+        self._dirty.set()
+        self._wake.set()
+        task, self._task = self._task, None
+        await task
+
+    async def _run(self) -> None:
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            try:
+                await asyncio.to_thread(save_checkpoint, self._progress, self._closed)
+            except Exception as e:
+                logger.warning(f"No se pudo guardar el checkpoint: {e}")
+            if self._closed and not self._dirty.is_set():
+                return
+            if not self._closed:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self._interval)  # flush() cuts the pause short
+                except asyncio.TimeoutError:
+                    pass
 
 def load_checkpoint(session_id: str) -> Optional[BatchProgress]:
     """Load progress from JSON checkpoint file."""
@@ -314,46 +652,316 @@ def load_checkpoint(session_id: str) -> Optional[BatchProgress]:
     try:
         with open(checkpoint_path, 'r', encoding='utf-8') as f:
             data = json.load(f)
-        return BatchProgress(**data)
+        # Checkpoints from before the concurrent batch kept a single current_tax_code
+        current_tax_code = data.pop("current_tax_code", None)
+        data.setdefault("in_flight_tax_codes", [current_tax_code] if current_tax_code else [])
+        progress = BatchProgress(**data)
+        _apply_checkpoint_journal(progress)
+        return progress
     except Exception as e:
         logger.error(f"Error loading checkpoint: {e}")
         return None
 
 def find_latest_checkpoint() -> Optional[BatchProgress]:
     """Find the most recent checkpoint file."""
-    checkpoint_files = list(OUTPUT_DIR.glob("checkpoint_*.json"))
+    global _checkpoint_index
+    # Fast path: pick the newest in_progress session from the index and load only that one
+    index = _load_checkpoint_index()
+    if index is not None:
+        # Writers swap in a new dict, so this snapshot never changes while being read
+        in_progress = [(entry["mtime"], session_id) for session_id, entry in list(index.items())
+                       if entry.get("status") == "in_progress"]
+        if not in_progress:
+            return None
+        _, session_id = max(in_progress)
+        progress = load_checkpoint(session_id)
+        if progress and progress.status == "in_progress":
+            return progress
+        # Index out of date (file deleted or edited by hand): fall back to the full scan
+
+    # Full scan (first run or stale index): parse every checkpoint once and rebuild the index
+    # (one stat() per file, reused for both the sort and the index)
+    checkpoint_files = [(p.stat().st_mtime, p) for p in OUTPUT_DIR.glob("checkpoint_*.json")
+                        if p != CHECKPOINT_INDEX_PATH]
 
     if not checkpoint_files:
         return None
 
     # Sort by modification time, most recent first
-    checkpoint_files.sort(key=lambda p: p.stat().st_mtime, reverse=True)
+    checkpoint_files.sort(key=lambda item: item[0], reverse=True)
 
-    # Load the most recent checkpoint that's in_progress
-    for checkpoint_file in checkpoint_files:
+    # Keep the most recent checkpoint that's in_progress
+    latest = None
+    index = {}
+    for mtime, checkpoint_file in checkpoint_files:
         session_id = checkpoint_file.stem.replace("checkpoint_", "")
         progress = load_checkpoint(session_id)
-        if progress and progress.status == "in_progress":
-            return progress
+        if not progress:
+            continue
+        index[session_id] = {"status": progress.status, "mtime": mtime}
+        if latest is None and progress.status == "in_progress":
+            latest = progress
 
-    return None
+    _checkpoint_index = index
+    try:
+        _write_json_atomic(CHECKPOINT_INDEX_PATH, index)
+    except OSError as e:
+        logger.warning(f"No se pudo reconstruir el índice de checkpoints: {e}")
+
+    return latest
+
+def delete_checkpoint(session_id: str) -> None:
+    """Remove a session's checkpoint, its journal and its index entry."""
+    global _checkpoint_index
+    get_checkpoint_path(session_id).unlink(missing_ok=True)
+    get_checkpoint_journal_path(session_id).unlink(missing_ok=True)
+    _checkpoint_persisted.pop(session_id, None)
+    index = _load_checkpoint_index()
+    if index is not None and session_id in index:
+        _checkpoint_index = {sid: entry for sid, entry in index.items() if sid != session_id}
+        try:
+            _write_json_atomic(CHECKPOINT_INDEX_PATH, _checkpoint_index)
+        except OSError as e:
+            logger.warning(f"No se pudo actualizar el índice de checkpoints: {e}")
+
+def checkpoint_is_stale(progress: BatchProgress, max_hours: float = CHECKPOINT_STALE_HOURS) -> bool:
+    """True if the session was started more than `max_hours` ago (or has no valid start time)."""
+    try:
+        started = datetime.strptime(progress.started_at, TS_FMT)
+    except ValueError:
+        return True
+    return datetime.now() - started > timedelta(hours=max_hours)
+
+# ---------------- Browser Profiles ---------------- #
+
+def get_profile_dir(cuit_login: str) -> Path:
+    """Get (and touch) the persistent profile directory for a login CUIT."""
+    digest = hashlib.sha1(cuit_login.encode()).hexdigest()[:12]
+    profile_dir = PROFILES_DIR / digest
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    os.utime(profile_dir)  # Mark as most recently used for prune_profiles
+    return profile_dir
+
+def prune_profiles(keep: int = PROFILES_KEEP, max_age: timedelta = PROFILES_MAX_AGE,
+                   in_use: frozenset = frozenset()) -> None:
+    """Delete profiles unused for `max_age`, and all but the `keep` most recently used.
+
+    Profiles in `in_use` (open in the browser pool) are never deleted.
+    """
+    if not PROFILES_DIR.exists():
+        return
+
+    cutoff = (datetime.now() - max_age).timestamp()
+    profiles = [(p.stat().st_mtime, p) for p in PROFILES_DIR.iterdir() if p.is_dir()]
+    profiles.sort(reverse=True)
+    for idx, (mtime, old_profile) in enumerate(profiles):
+        if old_profile in in_use:
+            continue
+        if idx >= keep or mtime < cutoff:
+            shutil.rmtree(old_profile, ignore_errors=True)
+            logger.info(f"Perfil antiguo eliminado: {old_profile}")
+
+# ---------------- Session State ---------------- #
+
+def get_state_path(cuit_login: str) -> Path:
+    """Get the storage state file for a login CUIT (same naming as its profile)."""
+    digest = hashlib.sha1(cuit_login.encode()).hexdigest()[:12]
+    return STATE_DIR / f"state_{digest}.json"
+
+def load_fresh_state(cuit_login: str) -> Optional[dict]:
+    """Return the saved storage state if younger than SESSION_MAX_AGE, else None."""
+    state_path = get_state_path(cuit_login)
+    try:
+        saved_at = datetime.fromtimestamp(state_path.stat().st_mtime)
+        if datetime.now() - saved_at > SESSION_MAX_AGE:
+            return None
+        with open(state_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# ---------------- Service URL ---------------- #
+
+def _read_mr_service_url_file() -> str:
+    try:
+        return MR_SERVICE_URL_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        return ""
+
+def _write_mr_service_url_file(text: str) -> None:
+    try:
+        MR_SERVICE_URL_FILE.parent.mkdir(parents=True, exist_ok=True)
+        MR_SERVICE_URL_FILE.write_text(text, encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"No se pudo guardar la URL de MIS RETENCIONES: {e}")
+
+def load_mr_service_url() -> Optional[str]:
+    """Return the learned MIS RETENCIONES URL, or None if not learned yet (or rejected)."""
+    url = _read_mr_service_url_file()
+    if not url or url.startswith("!"):
+        return None
+    return url
+
+def save_mr_service_url(url: str) -> None:
+    """Persist the MIS RETENCIONES URL (without query/fragment, which may carry SSO tokens).
+
+    A URL previously rejected by reject_mr_service_url() is not learned again.
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https"):
+        return
+    url = urlunsplit((parts.scheme, parts.netloc, parts.path, "", ""))
+    if _read_mr_service_url_file() in (url, f"!{url}"):
+        return
+    _write_mr_service_url_file(url)
+
+def reject_mr_service_url(url: str) -> None:
+    """The learned URL no longer opens the service: stop using it (and don't re-learn it)."""
+    _write_mr_service_url_file(f"!{url}")
+
+# ---------------- Browser Pool ---------------- #
+
+class BrowserPool:
+    """Keep one warm persistent Chromium context per login CUIT alive between runs.
+
+    The GUI runs every scrape on its long-lived event loop, so the browser (with its
+    cache and AFIP cookies) can outlive a single run. Playwright objects are bound to
+    the loop that created them: a run on another loop starts a fresh pool. At most
+    `max_contexts` browsers stay open; the least recently used one is closed first.
+    """
+
+    def __init__(self, max_contexts: int = PROFILES_KEEP):
+        self._loop = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._pw = None
+        self._max_contexts = max_contexts
+        # cuit_login -> (context, headless, profile_dir), least recently used first
+        self._contexts: Dict[str, tuple] = {}
+
+    async def acquire(self, cuit_login: str, headless: bool, on_log=print):
+        """Return the live context for `cuit_login`, launching Chromium if needed."""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._lock, self._pw, self._contexts = loop, asyncio.Lock(), None, {}
+
+        async with self._lock:
+            entry = self._contexts.get(cuit_login)
+            if entry and entry[1] == headless:
+                on_log("Reutilizando navegador ya abierto...")
+                self._contexts[cuit_login] = self._contexts.pop(cuit_login)  # Now the most recently used
+                return entry[0]
+            if entry:
+                await self._close_context(cuit_login)
+            while len(self._contexts) >= self._max_contexts:
+                await self._close_context(next(iter(self._contexts)))
+
+            if self._pw is None:
+                self._pw = await async_playwright().start()
+            profile_dir = get_profile_dir(cuit_login)
+            on_log(f"Usando perfil persistente: {profile_dir}")
+            context = await self._pw.chromium.launch_persistent_context(
+                user_data_dir=str(profile_dir),
+                headless=headless,
+                accept_downloads=True,
+                downloads_path=str(DOWNLOADS_TMP_DIR),
+                args=BROWSER_ARGS + (HEADLESS_ARGS if headless else [])
+            )
+            await _install_resource_blocking(context)
+            # The user may close the window between runs: forget the context then
+            context.on("close", lambda _: self._forget(cuit_login, context))
+            self._contexts[cuit_login] = (context, headless, profile_dir)
+            return context
+
+    async def release(self, context) -> None:
+        """Keep the context warm for the next run, trimmed to a single tab."""
+        if context.pages:
+            await _close_other_pages(context, context.pages[0])
+
+    @asynccontextmanager
+    async def session(self, cuit_login: str, headless: bool, on_log=print):
+        """`async with pool.session(...) as context:` - acquire, then release on exit."""
+        context = await self.acquire(cuit_login, headless, on_log=on_log)
+        try:
+            yield context
+        finally:
+            try:
+                await self.release(context)
+            except Exception:
+                pass
+
+    async def close(self) -> None:
+        """Close every pooled browser and stop Playwright."""
+        for cuit_login in list(self._contexts):
+            await self._close_context(cuit_login)
+        if self._pw is not None:
+            await self._pw.stop()
+            self._pw = None
+
+    def live_profile_dirs(self) -> frozenset:
+        """Profile directories of the open browsers (prune_profiles must keep them)."""
+        return frozenset(entry[2] for entry in list(self._contexts.values()))
+
+    def _forget(self, cuit_login: str, context) -> None:
+        entry = self._contexts.get(cuit_login)
+        if entry and entry[0] is context:
+            del self._contexts[cuit_login]
+
+    async def _close_context(self, cuit_login: str) -> None:
+        context = self._contexts.pop(cuit_login)[0]
+        try:
+            await context.close()
+        except Exception:
+            pass
+
+# Shared by every run (single and batch) in this process
+BROWSER_POOL = BrowserPool()
 
 # ---------------- Scraper Core ---------------- #
 
+# Fire-and-forget cleanup tasks; asyncio only keeps weak references, so hold them here
+_background_tasks: set = set()
+
+def _run_in_background(func, *args, description: str) -> None:
+    """Run blocking `func(*args)` in a worker thread without waiting for it; failures are logged."""
+    def _done(task: asyncio.Task) -> None:
+        _background_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(f"No se pudo {description}: {task.exception()}")
+        elif not task.cancelled():
+            logger.info(f"Tarea en segundo plano terminada: {description}")
+
+    task = asyncio.get_running_loop().create_task(asyncio.to_thread(func, *args))
+    _background_tasks.add(task)
+    task.add_done_callback(_done)
+
+async def _block_heavy_resources(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES or ANALYTICS_URL_RE.search(request.url):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _install_resource_blocking(context):
+    """Abort images, fonts, media and analytics for every page in the context."""
+    await context.route(BLOCKED_URL_RE, _block_heavy_resources)
+
 async def _apply_viewport(page):
     try:
-        await page.set_viewport_size({"width": 1920, "height": 1080})
+        await page.set_viewport_size(VIEWPORT)
     except Exception:
         pass
 
-async def _afip_login(context, cuit_login: str, clave: str, on_log=print):
-    """Login to AFIP portal."""
+async def _afip_login(context, cuit_login: str, clave: str, on_log=print) -> Tuple[object, bool]:
+    """Login to AFIP portal.
+
+    Returns:
+        (page, confirmed): confirmed is False when the portal never rendered its
+        services (wrong clave, captcha, slow portal); the run still continues.
+    """
     page = await context.new_page()
     await _apply_viewport(page)
     on_log("Navegando al login AFIP...")
     await page.goto(LOGIN_URL, wait_until="domcontentloaded")
-    await page.wait_for_load_state("networkidle")
-    await asyncio.sleep(1)
 
     # CUIT + Siguiente
     on_log("Ingresando CUIT...")
@@ -364,7 +972,6 @@ async def _afip_login(context, cuit_login: str, clave: str, on_log=print):
 
     on_log("Click en Siguiente...")
     await page.locator("#F1\\:btnSiguiente").click()
-    await page.wait_for_load_state("networkidle")
 
     # Clave + Ingresar
     on_log("Ingresando clave...")
@@ -374,40 +981,90 @@ async def _afip_login(context, cuit_login: str, clave: str, on_log=print):
     await pwd.fill(clave)
     await page.locator("#F1\\:btnIngresar").click()
 
-    await page.wait_for_load_state("networkidle", timeout=45000)
-    await asyncio.sleep(2)
+    # The portal is usable once the service tile (or 'Ver todos') is rendered
+    try:
+        await page.wait_for_selector(f"{MR_TILE_SELECTOR_COMBINED}, {VER_TODOS_SELECTOR}", timeout=45000)
+    except TimeoutError:
+        on_log("⚠ El portal todavía no muestra los servicios (¿clave o captcha?); continuando sin guardar la sesión...")
+        return page, False
     on_log("Login OK.")
+    return page, True
+
+async def _save_session(context, cuit_login: str, on_log=print) -> None:
+    """Persist the logged-in session so the next run can skip the login."""
+    try:
+        STATE_DIR.mkdir(parents=True, exist_ok=True)
+        state = await context.storage_state()
+        await asyncio.to_thread(_write_json_atomic, get_state_path(cuit_login), state)
+    except Exception as e:
+        on_log(f"⚠ No se pudo guardar la sesión: {e}")
+
+async def _restore_session(context, cuit_login: str, on_log=print):
+    """Reuse a recent AFIP session instead of logging in again.
+
+    Returns:
+        The portal page if the saved session is still valid, None otherwise
+    """
+    state = load_fresh_state(cuit_login)
+    if not state or not state.get("cookies"):
+        return None
+
+    on_log("Restaurando sesión AFIP guardada...")
+    await context.add_cookies(state["cookies"])
+    page = await context.new_page()
+    await _apply_viewport(page)
+    try:
+        await page.goto(PORTAL_URL, wait_until="domcontentloaded")
+        await page.wait_for_selector(f"{MR_TILE_SELECTOR_COMBINED}, {VER_TODOS_SELECTOR}", timeout=8000)
+    except Exception:
+        on_log("⚠ La sesión guardada expiró; se hace login completo.")
+        await page.close()
+        return None
+
+    on_log("✓ Sesión restaurada (login omitido).")
     return page
 
 async def _open_mis_retenciones(context, portal_page, on_log=print):
     """From the AFIP portal home, open 'MIS RETENCIONES' service."""
+    # Fast path: go straight to the service URL learned on a previous run.
+    # The direct page is opened in its own tab so the portal stays intact for the tile fallback.
+    service_url = load_mr_service_url()
+    if service_url:
+        on_log("Abriendo MIS RETENCIONES por URL directa...")
+        direct_page = await context.new_page()
+        try:
+            await direct_page.goto(service_url, wait_until="domcontentloaded")
+            await direct_page.wait_for_selector(SERVICE_READY_SELECTOR, timeout=10000)
+            await _apply_viewport(direct_page)
+            return direct_page
+        except Exception as e:
+            on_log(f"⚠ URL directa no disponible ({e}); usando el portal (no se volverá a intentar)...")
+            reject_mr_service_url(service_url)
+            await direct_page.close()
+
     on_log("Buscando servicio MIS RETENCIONES...")
 
     # Sometimes the tile is below a 'Ver todos' link
     try:
-        for sel in MR_TILE_SELECTORS:
-            if await portal_page.locator(sel).first.count():
-                break
-        else:
-            ver_todos = portal_page.locator("a:has-text('Ver todos'), a[href*='mis-servicios']")
+        if not await portal_page.locator(MR_TILE_SELECTOR_COMBINED).count():
+            ver_todos = portal_page.locator(VER_TODOS_SELECTOR)
             if await ver_todos.count():
                 await ver_todos.first.click()
-                await portal_page.wait_for_load_state("networkidle")
-                await asyncio.sleep(1)
+                await portal_page.wait_for_selector(MR_TILE_SELECTOR_COMBINED, timeout=15000)
     except Exception:
         pass
 
-    # Locate the tile/link
-    link = None
-    for sel in MR_TILE_SELECTORS:
-        candidate = portal_page.locator(sel).first
-        try:
-            await candidate.wait_for(state="visible", timeout=4000)
-            link = candidate
-            break
-        except TimeoutError:
-            continue
-    if link is None:
+    # Locate the tile/link: one wait, whichever candidate renders first wins
+    link = portal_page.locator(MR_TILE_SELECTOR_COMBINED).first
+    try:
+        await link.wait_for(state="visible", timeout=8000)
+    except TimeoutError:
+        # Debug aid: report which candidates are in the DOM at all (visible or not).
+        # The selectors use Playwright's :has-text, so they are counted with locators, concurrently.
+        counts = await asyncio.gather(
+            *(portal_page.locator(sel).count() for sel in MR_TILE_SELECTORS), return_exceptions=True
+        )
+        on_log(f"  [DEBUG] Tile no visible; coincidencias por selector: {dict(zip(MR_TILE_SELECTORS, counts))}")
         # Search by heading text as a fallback
         link = portal_page.locator("a:has(h3:has-text('MIS RETENCIONES'))").first
 
@@ -421,14 +1078,23 @@ async def _open_mis_retenciones(context, portal_page, on_log=print):
         on_log("El servicio se abrió en la misma pestaña.")
         new_page = portal_page
 
-    await new_page.wait_for_load_state("domcontentloaded")
-    await new_page.wait_for_load_state("networkidle")
     await _apply_viewport(new_page)
-    await asyncio.sleep(2)
+
+    # Wait for the SPA shell (form or user menu) instead of a load state;
+    # the selector wait also rides over the navigation of a freshly opened tab
+    try:
+        await new_page.wait_for_selector(SERVICE_READY_SELECTOR, timeout=20000)
+        save_mr_service_url(new_page.url)
+    except TimeoutError:
+        on_log("⚠ MIS RETENCIONES tarda en cargar; continuando...")
     return new_page
 
-async def _select_cuit_representado(page, cuit_target: str, on_log=print):
-    """Select CUIT (representado) from dropdown menu."""
+async def _select_cuit_representado(page, cuit_target: str, on_log=print) -> bool:
+    """Select CUIT (representado) from dropdown menu.
+
+    Returns:
+        bool: True if `cuit_target` was selected, False if the page stayed on the default CUIT
+    """
     try:
         on_log(f"Buscando dropdown de representados...")
 
@@ -437,44 +1103,70 @@ async def _select_cuit_representado(page, cuit_target: str, on_log=print):
         dropdown_btn = page.locator("#navBarMisRetenciones-dropdown-changeRelation, a[id*='dropdown-changeRelation']").first
 
         # First check if we need to open the user menu
-        user_dropdown = page.locator("#e-navbar-dropdown-toggle, a[data-bs-toggle='dropdown']").first
+        user_dropdown = page.locator(f"{USER_MENU_SELECTOR}, a[data-bs-toggle='dropdown']").first
         if await user_dropdown.count():
             on_log("Abriendo menú de usuario...")
             await user_dropdown.click()
-            await asyncio.sleep(1)
 
         # Click on "Seleccionar representado"
         await dropdown_btn.wait_for(state="visible", timeout=10000)
         await dropdown_btn.click()
-        await asyncio.sleep(1)
-        await page.wait_for_load_state("networkidle", timeout=15000)
+        await page.wait_for_selector("h6.e-relation__text--cuit", timeout=10000)
 
         on_log(f"Seleccionando CUIT objetivo: {cuit_target}...")
 
-        # The CUIT appears in format XX-XXXXXXXX-X
-        cuit_formatted = f"{cuit_target[:2]}-{cuit_target[2:10]}-{cuit_target[10]}"
+        # The CUIT appears in format XX-XXXXXXXX-X; one regex accepts it with or without dashes
+        cuit_pattern = re.compile(rf"{cuit_target[:2]}-?{cuit_target[2:10]}-?{cuit_target[10]}")
 
         # Find the card/panel with the target CUIT
         # According to Step_3, the CUIT is in: h6.e-relation__text--cuit
-        selector = f"h6.e-relation__text--cuit:has-text('{cuit_formatted}'), h6:has-text('{cuit_formatted}')"
-        cuit_element = page.locator(selector).first
+        cuit_element = page.locator("h6").filter(has_text=cuit_pattern).first
 
         if await cuit_element.count():
             # Click on the parent card
             card = cuit_element.locator("xpath=ancestor::div[contains(@class, 'e-relation__card') or contains(@class, 'card')]").first
             await card.wait_for(state="visible", timeout=5000)
-            on_log(f"Seleccionando CUIT: {cuit_formatted}...")
+            on_log(f"Seleccionando CUIT: {cuit_target}...")
             await card.click()
-            await page.wait_for_load_state("networkidle", timeout=20000)
-            await asyncio.sleep(2)
+            await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=20000)
             on_log("✓ CUIT seleccionado")
-        else:
-            on_log(f"⚠ CUIT {cuit_formatted} no encontrado en la lista. Continuando con CUIT por defecto...")
+            return True
+        on_log(f"⚠ CUIT {cuit_target} no encontrado en la lista. Continuando con CUIT por defecto...")
 
     except TimeoutError:
         on_log("⚠ Selector de representado no encontrado; se asume CUIT por defecto.")
     except Exception as e:
         on_log(f"⚠ Error al seleccionar CUIT: {e}")
+    return False
+
+async def _set_operation_type(page, operation_type: Optional[str], on_log=print):
+    """Check the 'Tipo de operación' radio ("1", "2", "0"); None skips the field."""
+    if operation_type is None:
+        return
+
+    on_log(f"Seleccionando tipo de operación: {operation_type}...")
+
+    # The radio buttons have values: "1" (Retención), "2" (Percepción), "0" (Retención y percepción)
+    radio_selector = f"input[type='radio'][value='{operation_type}']"
+    radio = page.locator(radio_selector).first
+
+    try:
+        await radio.wait_for(state="visible", timeout=5000)
+        await radio.check()
+        on_log("✓ Tipo de operación seleccionado")
+    except TimeoutError:
+        on_log(f"⚠ Campo 'Tipo de operación' no encontrado (puede ser esperado para algunos impuestos)")
+
+async def _form_keeps_values(page, tax_code: str, fecha_desde: str, fecha_hasta: str) -> bool:
+    """True if the form still has this impuesto selected and both dates filled in (one round trip)."""
+    return await page.evaluate(
+        """([option, desdeSel, hastaSel, desde, hasta]) =>
+            document.querySelector(option)?.getAttribute('aria-selected') === 'true'
+            && document.querySelector(desdeSel)?.value === desde
+            && document.querySelector(hastaSel)?.value === hasta""",
+        [f"#selectImpuestos-multiselect-option-{tax_code}", FECHA_DESDE_INPUT_SELECTOR,
+         FECHA_HASTA_INPUT_SELECTOR, fecha_desde, fecha_hasta]
+    )
 
 async def _fill_consulta_form(page, tax_code: str, operation_type: Optional[str], fecha_desde: str, fecha_hasta: str, on_log=print):
     """Fill the consulta form with tax type, operation type, and dates.
@@ -487,82 +1179,93 @@ async def _fill_consulta_form(page, tax_code: str, operation_type: Optional[str]
     """
     on_log("Llenando formulario de consulta...")
 
-    # Wait for the form to load
-    await page.wait_for_selector("#selectImpuestos, input#selectImpuestos", timeout=15000)
-
     # 1. Select tax type (Impuesto)
     on_log(f"Seleccionando impuesto: {tax_code}...")
 
-    # Click on the multiselect dropdown
-    impuesto_input = page.locator("#selectImpuestos")
-    await impuesto_input.wait_for(state="visible", timeout=10000)
-    await impuesto_input.click()
-    await asyncio.sleep(0.5)
+    # Click on the multiselect dropdown (click() auto-waits for the form to render)
+    impuesto_input = page.locator(FORM_READY_SELECTOR)
+    await impuesto_input.click(timeout=15000)
 
-    # Wait for dropdown to open
-    await page.wait_for_selector(f"#selectImpuestos-multiselect-option-{tax_code}", timeout=10000)
-
-    # Click on the specific option
-    option = page.locator(f"#selectImpuestos-multiselect-option-{tax_code}")
-    await option.scroll_into_view_if_needed()
-    await option.click()
-    await asyncio.sleep(0.5)
+    # Click on the specific option once the dropdown renders it (click() scrolls it into view)
+    option_selector = f"#selectImpuestos-multiselect-option-{tax_code}"
+    await page.locator(option_selector).click(timeout=10000)
+    # The multiselect marks the chosen option (it stays in the DOM while the dropdown hides)
+    try:
+        await page.wait_for_selector(f"{option_selector}[aria-selected='true']", state="attached", timeout=5000)
+    except TimeoutError:
+        on_log("  [DEBUG] La opción no quedó marcada como seleccionada; continuando...")
     on_log("✓ Impuesto seleccionado")
 
     # 2. Select operation type (Tipo de operación) - if applicable
-    if operation_type is not None:
-        on_log(f"Seleccionando tipo de operación: {operation_type}...")
-
-        # The radio buttons have values: "1" (Retención), "2" (Percepción), "0" (Retención y percepción)
-        radio_selector = f"input[type='radio'][value='{operation_type}']"
-        radio = page.locator(radio_selector).first
-
-        try:
-            await radio.wait_for(state="visible", timeout=5000)
-            await radio.check()
-            await asyncio.sleep(0.3)
-            on_log("✓ Tipo de operación seleccionado")
-        except TimeoutError:
-            on_log(f"⚠ Campo 'Tipo de operación' no encontrado (puede ser esperado para algunos impuestos)")
+    await _set_operation_type(page, operation_type, on_log=on_log)
 
     # 3. Fill dates
     on_log(f"Completando fechas: {fecha_desde} - {fecha_hasta}...")
 
     # Fecha desde - TIPEO MANUAL
     on_log(f"  [DEBUG] Ingresando fecha desde manualmente: {fecha_desde}")
-    fecha_desde_input = page.locator("#datePickerFechasRetencionesDesde__input")
-    await fecha_desde_input.wait_for(state="visible", timeout=10000)
-
-    # Click para hacer focus
-    await fecha_desde_input.click()
-    await asyncio.sleep(0.3)
+    # The date inputs are not re-rendered by the form: resolve each to a handle once
+    # (the wait returns it) instead of re-querying the selector on every action
+    fecha_desde_input = await page.wait_for_selector(FECHA_DESDE_INPUT_SELECTOR, state="visible", timeout=10000)
 
-    # CRITICAL: Clear primero, luego fill
-    await fecha_desde_input.fill("")  # Clear
-    await asyncio.sleep(0.2)
+    # fill() focuses, clears and sets the value in a single call
     await fecha_desde_input.fill(fecha_desde)  # dd/mm/yyyy
-    await asyncio.sleep(0.5)
+
+    # Only if the date picker rejected the value, retype it as keystrokes
+    if await fecha_desde_input.input_value() != fecha_desde:
+        on_log("  [DEBUG] fill() no quedó aplicado, tipeando la fecha...")
+        await fecha_desde_input.fill("")
+        await fecha_desde_input.type(fecha_desde, delay=0)
 
     # NO usar Tab - simplemente hacer click afuera para confirmar
     await page.locator("body").click(position={"x": 0, "y": 0})  # Click en esquina superior
-    await asyncio.sleep(0.3)
 
     on_log(f"  ✓ Fecha desde ingresada: {fecha_desde}")
 
-    # Fecha hasta - CON NAVEGACIÓN EN CALENDARIO
+    # Fecha hasta - typed straight into the input like fecha desde; the calendar is only a fallback
+    on_log(f"  [DEBUG] Ingresando fecha hasta directamente: {fecha_hasta}")
+    await page.wait_for_selector(FECHA_HASTA_INPUT_SELECTOR, state="visible", timeout=10000)
+    if await _set_input_value(page, FECHA_HASTA_INPUT_SELECTOR, fecha_hasta):
+        on_log(f"  ✓ Fecha hasta ingresada: {fecha_hasta}")
+    else:
+        on_log("  [DEBUG] El datepicker rechazó el valor; usando el calendario...")
+        await _pick_fecha_hasta_in_calendar(page, fecha_hasta, on_log=on_log)
+
+    on_log("✓ Formulario completado")
+
+async def _set_input_value(page, selector: str, value: str) -> bool:
+    """Set an input's value the way a user edit would (native setter + input/change + blur).
+
+    Returns:
+        True if, after Vue re-rendered, the input still holds `value` and is not marked invalid
+    """
+    return await page.evaluate(
+        """async ([sel, value]) => {
+            const el = document.querySelector(sel);
+            if (!el) return false;
+            const setter = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+            setter.call(el, value);
+            el.dispatchEvent(new Event('input', {bubbles: true}));
+            el.dispatchEvent(new Event('change', {bubbles: true}));
+            el.blur();
+            await new Promise(r => requestAnimationFrame(() => r()));
+            return el.value === value && !el.closest('.is-invalid');
+        }""",
+        [selector, value]
+    )
+
+async def _pick_fecha_hasta_in_calendar(page, fecha_hasta: str, on_log=print):
+    """Select fecha hasta by navigating the v-calendar popup and clicking the day."""
     on_log(f"  [DEBUG] Seleccionando fecha hasta con calendario: {fecha_hasta}")
-    fecha_hasta_input = page.locator("#datePickerFechasRetencionesHasta__input")
-    await fecha_hasta_input.wait_for(state="visible", timeout=10000)
+    fecha_hasta_input = await page.wait_for_selector(FECHA_HASTA_INPUT_SELECTOR, state="visible", timeout=10000)
 
     # Abrir calendario
     on_log(f"  [DEBUG] Abriendo calendario 'Fecha hasta'...")
     await fecha_hasta_input.click()
-    await asyncio.sleep(0.5)
 
     # Esperar que se renderice
     on_log(f"  [DEBUG] Esperando que se renderice el calendario...")
     await page.wait_for_selector('.vc-pane-container', state='visible', timeout=10000)
-    await asyncio.sleep(0.5)
 
     # Parsear fecha objetivo
     fecha_obj = datetime.strptime(fecha_hasta, "%d/%m/%Y")
@@ -579,9 +1282,9 @@ async def _fill_consulta_form(page, tax_code: str, operation_type: Optional[str]
     day_selector_hasta = f'.vc-day.id-{fecha_hasta_calendar}'
 
     on_log(f"  [DEBUG] Verificando si día {fecha_hasta_calendar} está visible...")
-    day_element = page.locator(day_selector_hasta)
+    day_element = await page.query_selector(day_selector_hasta)
 
-    if await day_element.count() == 0:
+    if day_element is None:
         on_log(f"  [ERROR] Día {fecha_hasta_calendar} no encontrado en DOM después de navegación")
         # Dump HTML for debugging
         calendar_html = await page.locator('.vc-pane-container').inner_html()
@@ -590,11 +1293,16 @@ async def _fill_consulta_form(page, tax_code: str, operation_type: Optional[str]
 
     on_log(f"  [DEBUG] Haciendo click en día: {day_selector_hasta}")
     await day_element.click(timeout=5000)
-    await asyncio.sleep(0.5)
+    try:
+        await page.wait_for_function(
+            "([sel, value]) => document.querySelector(sel)?.value === value",
+            arg=[FECHA_HASTA_INPUT_SELECTOR, fecha_hasta],
+            timeout=3000
+        )
+    except TimeoutError:
+        on_log("  [DEBUG] El input 'Fecha hasta' no reflejó la fecha todavía; continuando...")
     on_log(f"  ✓ Fecha hasta seleccionada: {fecha_hasta}")
 
-    on_log("✓ Formulario completado")
-
 async def _click_consultar(page, on_log=print):
     """Click the 'Consultar' button and wait for results.
     
@@ -603,14 +1311,15 @@ async def _click_consultar(page, on_log=print):
     """
     on_log("Haciendo click en Consultar...")
 
-    consultar_btn = page.locator("#btnConsultarRetenciones, button#btnConsultarRetenciones")
-    await consultar_btn.wait_for(state="visible", timeout=10000)
-    await consultar_btn.scroll_into_view_if_needed()
-    await consultar_btn.click()
+    consultar_btn = page.locator(CONSULTAR_BTN_SELECTOR)
+    await consultar_btn.click(timeout=10000)
 
-    # Wait for results to load
+    # Wait for results to load: either the export button or the empty-state message
     on_log("Esperando resultados...")
-    await asyncio.sleep(3)
+    try:
+        await page.wait_for_selector(f"{EXPORT_BTN_SELECTOR}, .e-empty", state="visible", timeout=15000)
+    except TimeoutError:
+        pass
 
     # NUEVO: Primero verificar si apareció el mensaje de "No hay resultados"
     no_results_selectors = [
@@ -628,10 +1337,10 @@ async def _click_consultar(page, on_log=print):
                 # Clickear "Volver a consultar" para poder continuar con el siguiente
                 on_log("  → Clickeando 'Volver a consultar'...")
                 try:
-                    volver_btn = page.locator("#btnNuevaBusqueda, button#btnNuevaBusqueda").first
+                    volver_btn = page.locator(NUEVA_BUSQUEDA_BTN_SELECTOR).first
                     await volver_btn.wait_for(state="visible", timeout=5000)
                     await volver_btn.click()
-                    await asyncio.sleep(1.5)
+                    await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=10000)
                     on_log("  ✓ Volviendo a formulario de consulta")
                 except Exception as e:
                     on_log(f"  ⚠ Error al clickear 'Volver a consultar': {e}")
@@ -643,8 +1352,8 @@ async def _click_consultar(page, on_log=print):
     # Si llegamos acá, no encontramos el mensaje de "no hay resultados" inmediato
     # Ahora verificar si apareció el botón de exportar y si está ENABLED
     try:
-        await page.wait_for_selector("#btnExportarOtrosFormatos, button#btnExportarOtrosFormatos", timeout=15000)
-        export_btn = page.locator("#btnExportarOtrosFormatos, button#btnExportarOtrosFormatos").first
+        await page.wait_for_selector(EXPORT_BTN_SELECTOR, timeout=15000)
+        export_btn = page.locator(EXPORT_BTN_SELECTOR).first
         
         # CRITICAL: Verificar si el botón está ENABLED o DISABLED
         is_enabled = await export_btn.is_enabled()
@@ -657,8 +1366,19 @@ async def _click_consultar(page, on_log=print):
             on_log("⚠ Botón exportar apareció pero está DISABLED")
             on_log("  → Esperando mensaje 'No hay resultados'...")
             
-            # Esperar un poco más a que aparezca el mensaje
-            await asyncio.sleep(2)
+            # Esperar a que aparezca el mensaje o a que el botón se habilite (resultados aún cargando)
+            try:
+                await page.wait_for_function(
+                    "([btn, empty]) => { const b = document.querySelector(btn); return (b && !b.disabled) || !!document.querySelector(empty); }",
+                    arg=[EXPORT_BTN_SELECTOR, ".e-empty"],
+                    timeout=5000
+                )
+            except TimeoutError:
+                pass
+
+            if await export_btn.is_enabled():
+                on_log("✓ Resultados cargados - Botón exportar ENABLED")
+                return True
             
             # Verificar nuevamente si apareció el mensaje de "No hay resultados"
             for selector in no_results_selectors:
@@ -669,10 +1389,10 @@ async def _click_consultar(page, on_log=print):
                         
                         # Clickear "Volver a consultar"
                         try:
-                            volver_btn = page.locator("#btnNuevaBusqueda, button#btnNuevaBusqueda").first
+                            volver_btn = page.locator(NUEVA_BUSQUEDA_BTN_SELECTOR).first
                             await volver_btn.wait_for(state="visible", timeout=5000)
                             await volver_btn.click()
-                            await asyncio.sleep(1.5)
+                            await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=10000)
                             on_log("  ✓ Volviendo a formulario de consulta")
                         except Exception as e:
                             on_log(f"  ⚠ Error al clickear 'Volver a consultar': {e}")
@@ -685,10 +1405,10 @@ async def _click_consultar(page, on_log=print):
             # Asumir que no hay datos de todas formas
             on_log("  ⚠ Botón disabled sin mensaje claro - asumiendo sin datos")
             try:
-                volver_btn = page.locator("#btnNuevaBusqueda, button#btnNuevaBusqueda").first
+                volver_btn = page.locator(NUEVA_BUSQUEDA_BTN_SELECTOR).first
                 if await volver_btn.count() > 0:
                     await volver_btn.click()
-                    await asyncio.sleep(1.5)
+                    await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=10000)
             except Exception:
                 pass
             
@@ -701,55 +1421,130 @@ async def _click_consultar(page, on_log=print):
         
         # Intentar volver igual por si acaso
         try:
-            volver_btn = page.locator("#btnNuevaBusqueda, button#btnNuevaBusqueda").first
+            volver_btn = page.locator(NUEVA_BUSQUEDA_BTN_SELECTOR).first
             if await volver_btn.count() > 0:
                 await volver_btn.click()
-                await asyncio.sleep(1.5)
+                await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=10000)
         except Exception:
             pass
         
         return False  # Asumir que no hay resultados
 
 
+def _is_export_request(response) -> bool:
+    """True for the XHR that registers a CSV export (not the file download)."""
+    return bool(EXPORT_API_RE.search(response.url)) and "descarga" not in response.url
+
 async def _export_csv(page, on_log=print):
-    """Click the Export dropdown and select CSV."""
+    """Click the Export dropdown and select CSV.
+
+    Returns:
+        Tuple (export_pid, download, modal_shown):
+        - export_pid: Export id (pid) read from AFIP's JSON response, used to
+          find this export in "Consultas exportadas". None if it wasn't captured.
+        - download: Playwright Download when AFIP served the file right away
+          (small exports); None when the export was queued.
+        - modal_shown: Whether the "export queued" modal was seen.
+    """
     on_log("Exportando a CSV...")
 
     # Click on the Export dropdown button
     on_log("  [DEBUG] Buscando botón 'Exportar'...")
-    export_btn = page.locator("#btnExportarOtrosFormatos, button#btnExportarOtrosFormatos")
-    await export_btn.wait_for(state="visible", timeout=15000)
-    await export_btn.scroll_into_view_if_needed()
+    export_btn = page.locator(EXPORT_BTN_SELECTOR)
     on_log("  [DEBUG] Click en botón 'Exportar'...")
-    await export_btn.click()
-    await asyncio.sleep(1)
+    await export_btn.click(timeout=15000)
 
     # Wait for dropdown menu to appear
     on_log("  [DEBUG] Esperando menú dropdown...")
-    await page.wait_for_selector(".dropdown-menu a.dropdown-item:has-text('.CSV')", timeout=10000)
+    csv_option = page.locator(".dropdown-menu a.dropdown-item:has-text('.CSV')").first
+    await csv_option.wait_for(state="visible", timeout=10000)
     on_log("  [DEBUG] Menú dropdown visible")
 
+    # Small exports are served immediately as a browser download: listen for it from before
+    # the click so "Consultas exportadas" can be skipped entirely in that case
+    download_waiter = asyncio.ensure_future(page.wait_for_event("download", timeout=15000))
+    download_waiter.add_done_callback(lambda t: t.cancelled() or t.exception())  # Timeouts are expected
+
     # Click on CSV option
     on_log("  [DEBUG] Click en opción '.CSV'...")
-    csv_option = page.locator(".dropdown-menu a.dropdown-item:has-text('.CSV')").first
-    await csv_option.click()
+    export_pid = None
+    try:
+        async with page.expect_response(_is_export_request, timeout=10000) as response_info:
+            await csv_option.click()
+        response = await response_info.value
+        pid_match = EXPORT_PID_RE.search(await response.text())
+        if pid_match:
+            export_pid = pid_match.group(0)
+            on_log(f"  [DEBUG] Id de exportación: {export_pid}")
+    except Exception as e:
+        on_log(f"  [DEBUG] No se capturó el id de exportación: {e}")
 
-    # Wait longer for the modal to appear (it takes 3-5 seconds)
-    on_log("  [DEBUG] Esperando a que aparezca el modal de exportación (puede tomar 5-7 segundos)...")
-    await asyncio.sleep(4)
+    # Wait for the modal itself instead of a fixed delay (it usually takes 3-5 seconds)
+    on_log("  [DEBUG] Esperando a que aparezca el modal de exportación...")
+    modal_shown = False
+    try:
+        await page.wait_for_selector("#modal-sinresultados, .modal.show", state="visible", timeout=7000)
+        modal_shown = True
+    except TimeoutError:
+        on_log("  [DEBUG] El modal no apareció todavía; se sigue sin esperar más")
+
+    # The modal means the export was queued; without it give the direct download a moment longer
+    if not modal_shown and not download_waiter.done():
+        await asyncio.wait({download_waiter}, timeout=5)
+
+    download = None
+    if download_waiter.done():
+        if download_waiter.exception() is None:
+            download = download_waiter.result()
+            on_log("  [DEBUG] AFIP entregó el archivo directamente (sin cola)")
+    else:
+        download_waiter.cancel()
 
     on_log("✓ Click en CSV completado - exportación iniciada")
+    return export_pid, download, modal_shown
 
-async def _handle_export_popup(page, on_log=print):
+# Winning selector of each fallback list, remembered for the rest of the run: AFIP's DOM
+# does not change mid-run, so later calls skip the probes that already failed once
+_SELECTOR_CACHE: Dict[str, str] = {}
+
+async def _first_match(page, key: str, selectors: List[str], timeout: int = 5000, on_log=print):
+    """Return a locator for the first of `selectors` present and visible, or None.
+
+    The selector that wins is cached under `key`; if it stops matching, the full list is probed again.
+    """
+    cached = _SELECTOR_CACHE.get(key)
+    if cached:
+        candidate = page.locator(cached).first
+        try:
+            await candidate.wait_for(state="visible", timeout=timeout)
+            return candidate
+        except TimeoutError:
+            _SELECTOR_CACHE.pop(key, None)
+
+    for idx, selector in enumerate(selectors, 1):
+        candidate = page.locator(selector).first
+        try:
+            if await candidate.count():
+                await candidate.wait_for(state="visible", timeout=timeout)
+                _SELECTOR_CACHE[key] = selector
+                on_log(f"  [DEBUG] '{key}' encontrado con selector #{idx}: {selector}")
+                return candidate
+        except Exception as e:
+            on_log(f"  [DEBUG] Selector #{idx} falló: {e}")
+    return None
+
+async def _handle_export_popup(page, on_log=print, modal_timeout: int = 12000):
     """Navigate to 'Consultas exportadas' tab after export.
 
     NOTE: The modal popup usually appears after 3-5 seconds after clicking CSV export.
     We need to wait for it and click "Ver archivo" button.
+
+    Args:
+        modal_timeout: ms to wait for the modal; callers that already waited for it pass less
     """
     on_log("[DEBUG] Verificando si aparece popup de exportación...")
 
-    # Try multiple selectors for the modal with extended timeout
-    modal_appeared = False
+    # All modal variants in one wait: returns as soon as any of them is visible
     modal_selectors = [
         "#modal-sinresultados",  # Main modal container
         "#modal-sinresultados_content",  # Modal content
@@ -757,19 +1552,18 @@ async def _handle_export_popup(page, on_log=print):
         ".modal-content",  # Generic modal content
     ]
 
-    for idx, selector in enumerate(modal_selectors, 1):
-        try:
-            on_log(f"  [DEBUG] Probando selector de modal #{idx}: {selector} (timeout: 10s)")
-            await page.wait_for_selector(selector, state="visible", timeout=10000)
-            modal_appeared = True
-            on_log(f"✓ Popup apareció con selector: {selector}")
-            break
-        except TimeoutError:
-            on_log(f"  [DEBUG] Selector #{idx} timeout: {selector}")
-            continue
-
-    if not modal_appeared:
-        on_log("  [DEBUG] Popup NO apareció después de probar todos los selectores")
+    try:
+        await page.wait_for_selector(", ".join(modal_selectors), state="visible", timeout=modal_timeout)
+        modal_appeared = True
+        on_log("✓ Popup de exportación visible")
+        if logger.isEnabledFor(logging.DEBUG):
+            matched = await page.evaluate(
+                "(sels) => sels.find(s => document.querySelector(s)) || null", modal_selectors
+            )
+            logger.debug(f"Popup de exportación detectado con selector: {matched}")
+    except TimeoutError:
+        modal_appeared = False
+        on_log(f"  [DEBUG] Popup NO apareció ({modal_timeout / 1000:g}s)")
 
     if modal_appeared:
         # Modal appeared, click "Ver archivo" button
@@ -784,31 +1578,13 @@ async def _handle_export_popup(page, on_log=print):
             ".modal.show button:has-text('Ver archivo')",  # In visible modal by text
         ]
 
-        ver_archivo_btn = None
-        for idx, selector in enumerate(selectors_to_try, 1):
-            try:
-                on_log(f"  [DEBUG] Probando selector de botón #{idx}: {selector}")
-                candidate = page.locator(selector).first
-                count = await candidate.count()
-                on_log(f"  [DEBUG] Selector #{idx} encontró {count} elemento(s)")
-
-                if count > 0:
-                    await candidate.wait_for(state="visible", timeout=5000)
-                    ver_archivo_btn = candidate
-                    on_log(f"✓ Botón 'Ver archivo' encontrado con selector #{idx}: {selector}")
-                    break
-            except Exception as e:
-                on_log(f"  [DEBUG] Selector #{idx} falló: {e}")
-                continue
+        ver_archivo_btn = await _first_match(page, "ver_archivo_btn", selectors_to_try, on_log=on_log)
 
         if ver_archivo_btn:
-            await ver_archivo_btn.scroll_into_view_if_needed()
-            await asyncio.sleep(0.5)
             on_log("Haciendo click en botón 'Ver archivo'...")
             await ver_archivo_btn.click()
-            on_log("  [DEBUG] Click realizado, esperando navegación...")
-            await page.wait_for_load_state("networkidle", timeout=20000)
-            await asyncio.sleep(2)
+            on_log("  [DEBUG] Click realizado, esperando la primera fila de la grilla...")
+            await page.wait_for_selector(EXPORTS_FIRST_ROW_SELECTOR, state="visible", timeout=20000)
             on_log("✓ Navegado a 'Consultas exportadas' (vía popup)")
             return
         else:
@@ -817,9 +1593,6 @@ async def _handle_export_popup(page, on_log=print):
     # New behavior (default): No popup, manually navigate to "Consultas exportadas" tab
     on_log("Navegando manualmente a tab 'Consultas exportadas'...")
 
-    # Wait a bit for the export to be registered
-    await asyncio.sleep(2)
-
     # Try to find and click the "Consultas exportadas" tab
     tab_selectors = [
         "button#tabConsultasExportdas-tab",
@@ -832,75 +1605,87 @@ async def _handle_export_popup(page, on_log=print):
     on_log("  [DEBUG] Buscando tab 'Consultas exportadas'...")
     tab_found = False
 
-    for idx, selector in enumerate(tab_selectors, 1):
+    tab = await _first_match(page, "exportadas_tab", tab_selectors, on_log=on_log)
+    if tab:
         try:
-            on_log(f"  [DEBUG] Probando selector #{idx}: {selector}")
-            tab = page.locator(selector).first
-            if await tab.count() > 0:
-                on_log(f"  [DEBUG] Tab encontrada con selector #{idx}")
-                await tab.wait_for(state="visible", timeout=5000)
-                await tab.scroll_into_view_if_needed()
-                await asyncio.sleep(0.5)
-                on_log(f"  [DEBUG] Click en tab 'Consultas exportadas'...")
-                await tab.click()
-                await asyncio.sleep(2)
-                await page.wait_for_load_state("networkidle", timeout=15000)
-                tab_found = True
-                on_log("✓ Navegado a 'Consultas exportadas' (vía tab)")
-                break
+            on_log(f"  [DEBUG] Click en tab 'Consultas exportadas'...")
+            await tab.click(timeout=5000)
+            await page.wait_for_selector(EXPORTS_FIRST_ROW_SELECTOR, state="visible", timeout=15000)
+            tab_found = True
+            on_log("✓ Navegado a 'Consultas exportadas' (vía tab)")
         except Exception as e:
-            on_log(f"  [DEBUG] Selector #{idx} falló: {e}")
-            continue
+            on_log(f"  [DEBUG] Click en tab falló: {e}")
 
     if not tab_found:
         on_log("⚠ No se pudo encontrar tab 'Consultas exportadas' - continuando de todas formas...")
 
-    await asyncio.sleep(2)
+async def _save_download(download, save_path: Path) -> None:
+    """Move Playwright's finished download into `save_path`.
 
-async def _resolve_first_row_download_anchor(page, on_log=print):
-    """Return the <a download> for row 0 in the CENTER container, with many fallbacks."""
-    center = page.locator(".ag-center-cols-container").first
-    await center.wait_for(timeout=15000)
+    Downloads are staged in DOWNLOADS_TMP_DIR, next to OUTPUT_DIR, so this is
+    normally an O(1) rename; across devices it falls back to a threaded copy.
+    """
+    src_path = await download.path()
+    try:
+        os.replace(src_path, save_path)
+    except OSError:
+        await asyncio.to_thread(shutil.copyfile, src_path, save_path)
+
+# Static fallbacks for the row-0 download anchor, built once (strongest → weakest)
+ROW0_ANCHOR_STRATEGIES = (
+    # 1) Most direct: row-index=0 + filename column + anchor with download
+    '.ag-row[row-index="0"] [col-id="filename"] a[download]',
+    # 2) Same via ARIA column index (6 in your dump)
+    '.ag-row[row-index="0"] [role="gridcell"][aria-colindex="6"] a[download]',
+    # 3) First visible row → filename column → anchor
+    '.ag-row[role="row"]:nth-match(1) [col-id="filename"] a[download]',
+    # 4) First visible row → any a[download] (if col-id moved)
+    '.ag-row[role="row"]:nth-match(1) a[download]',
+)
+
+async def _resolve_first_row_download_anchor(page, on_log=print, export_pid: Optional[str] = None,
+                                             pid_only: bool = False):
+    """Return the <a download> for row 0 in the CENTER container, with many fallbacks.
+
+    If `export_pid` is known, the anchor whose href carries that pid is tried first.
+    With `pid_only` it is the only one tried (other tabs may have exported since).
+    """
+    center = page.locator(EXPORTS_GRID_SELECTOR).first
 
-    # Make sure some rows exist (AG Grid can be slow to paint)
-    if await center.locator('.ag-row[role="row"]').count() == 0:
-        await page.wait_for_selector('.ag-center-cols-container .ag-row[role="row"]', timeout=15000)
+    # Make sure some rows exist (AG Grid can be slow to paint); returns at once when they do,
+    # so grid + row presence cost one round trip instead of wait + count + wait
+    await page.wait_for_selector(f'{EXPORTS_GRID_SELECTOR} .ag-row[role="row"]', timeout=15000)
 
     # Ordered selector strategies (strongest → weakest)
     strategies = [
-        # 1) Most direct: row-index=0 + filename column + anchor with download
-        '.ag-row[row-index="0"] [col-id="filename"] a[download]',
-        # 2) Same via ARIA column index (6 in your dump)
-        '.ag-row[row-index="0"] [role="gridcell"][aria-colindex="6"] a[download]',
-        # 3) First visible row → filename column → anchor
-        '.ag-row[role="row"]:nth-match(1) [col-id="filename"] a[download]',
-        # 4) First visible row → any a[download] (if col-id moved)
-        '.ag-row[role="row"]:nth-match(1) a[download]',
+        # 0) Exact export: anchor whose href carries our export pid
+        *([f'[col-id="filename"] a[download][href*="pid={export_pid}"]'] if export_pid else []),
+        *(() if pid_only else ROW0_ANCHOR_STRATEGIES),
     ]
 
     for idx, sel in enumerate(strategies, 1):
         loc = center.locator(sel).first
         try:
-            if await loc.count() > 0:
-                await loc.wait_for(state="visible", timeout=4000)
+            # is_visible() answers presence + visibility in one call (no wait)
+            if await loc.is_visible():
                 on_log(f"  [DEBUG] Selector strategy #{idx} matched: {sel}")
                 return loc
         except Exception:
             on_log(f"  [DEBUG] Selector strategy #{idx} no match: {sel}")
 
+    if pid_only:
+        return None
+
     # 5) Sweep: check all anchors in filename column; pick the one whose closest row has row-index="0"
+    #    (one evaluate over every anchor, instead of a count plus one round trip per anchor)
     anchors = center.locator('[col-id="filename"] a[download]')
-    if await anchors.count() > 0:
-        n = await anchors.count()
-        for i in range(min(n, 20)):
-            a = anchors.nth(i)
-            try:
-                row_ix = await a.evaluate("el => el.closest('.ag-row')?.getAttribute('row-index')")
-                if row_ix == "0":
-                    on_log("  [DEBUG] Sweep found row-index=0 anchor")
-                    return a
-            except Exception:
-                continue
+    n, row0_idx = await anchors.evaluate_all(
+        "els => [els.length, els.findIndex(el => el.closest('.ag-row')?.getAttribute('row-index') === '0')]"
+    )
+    if n > 0:
+        if row0_idx >= 0:
+            on_log("  [DEBUG] Sweep found row-index=0 anchor")
+            return anchors.nth(row0_idx)
 
         # As an ultra‑last fallback, if row-index probing fails, take the first visible anchor in the center
         on_log("  [DEBUG] Sweep fallback: using first visible anchor in center container")
@@ -908,6 +1693,81 @@ async def _resolve_first_row_download_anchor(page, on_log=print):
 
     return None
 
+async def _download_export_by_pid(page, export_pid: str, cuit_target: str, save_path: Path, on_log=print) -> Optional[str]:
+    """Fetch an export straight from the download API, reusing the browser session cookies.
+
+    Returns:
+        Optional[str]: File path if the export was ready, None otherwise
+    """
+    url = urljoin(page.url, f"{EXPORT_DOWNLOAD_PATH}?pid={export_pid}&cuitRetenido={cuit_target}")
+    try:
+        resp = await page.context.request.get(url)
+    except Exception as e:
+        on_log(f"  [DEBUG] Descarga directa falló: {e}")
+        return None
+
+    # While the export is still being generated AFIP answers with an error or a JSON/HTML body
+    content_type = resp.headers.get("content-type", "")
+    if not resp.ok or "json" in content_type or "html" in content_type:
+        on_log(f"  [DEBUG] Descarga directa no disponible todavía (HTTP {resp.status}, {content_type or 'sin tipo'})")
+        return None
+
+    body = await resp.body()
+    await asyncio.to_thread(save_path.write_bytes, body)
+    on_log(f"✓ Archivo descargado (directo por pid): {save_path}")
+    return str(save_path)
+
+def _build_download_path(tax_code: str, cuit_target: str, fecha_desde: str, fecha_hasta: str) -> Path:
+    """Build a friendly, unique output path for a downloaded CSV."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    desde_fmt = fecha_desde.replace("/", "")
+    hasta_fmt = fecha_hasta.replace("/", "")
+    return OUTPUT_DIR / f"MR_{tax_code}_{cuit_target}_{desde_fmt}_{hasta_fmt}_{timestamp}.csv"
+
+async def _export_row_ready(page, export_pid: Optional[str], timeout_s: float, pid_only: bool = False) -> bool:
+    """Wait in-page (no refresh) until the export's row carries a download link.
+
+    With `export_pid` (and pid-style hrefs in the grid, or `pid_only`) the link must point
+    at that export; otherwise any link in row 0 counts.
+    """
+    try:
+        await page.wait_for_function(
+            """([grid, pid, pidOnly]) => {
+                const g = document.querySelector(grid);
+                if (!g) return false;
+                if (pid && (pidOnly || g.querySelector('[col-id="filename"] a[download][href*="pid="]')))
+                    return !!g.querySelector(`[col-id="filename"] a[download][href*="pid=${pid}"]`);
+                return !!g.querySelector('.ag-row[row-index="0"] a[download]');
+            }""",
+            arg=[EXPORTS_GRID_SELECTOR, export_pid, pid_only],
+            timeout=timeout_s * 1000,
+            polling=250
+        )
+        return True
+    except TimeoutError:
+        return False
+
+def _export_record_finished(data, export_pid: str) -> bool:
+    """True if a "Consultas exportadas" listing has our export finished.
+
+    The listing's exact shape is not fixed, so any JSON object that mentions the pid is
+    checked: it counts as finished with an estado/status of "Finalizado" or a download link.
+    """
+    if isinstance(data, list):
+        return any(_export_record_finished(item, export_pid) for item in data)
+    if not isinstance(data, dict):
+        return False
+    values = [v for v in data.values() if isinstance(v, str)]
+    if any(export_pid in v for v in values):
+        for key, value in data.items():
+            if not isinstance(value, str):
+                continue
+            if any(word in key.lower() for word in ("estado", "status")) and value.lower().startswith("finaliz"):
+                return True
+            if f"pid={export_pid}" in value:
+                return True
+    return any(_export_record_finished(v, export_pid) for v in data.values() if isinstance(v, (dict, list)))
+
 async def _wait_and_download_file(
     page,
     tax_code: str,
@@ -915,108 +1775,209 @@ async def _wait_and_download_file(
     fecha_desde: str,
     fecha_hasta: str,
     on_log=print,
-    max_wait_minutes=2
+    max_wait_minutes=2,
+    export_pid: Optional[str] = None,
+    pid_only: bool = False
 ):
     """Click the first-row download, with multiple selector + transport fallbacks.
-       No dependence on 'Finalizado'. Works against AG Grid's center container."""
+       No dependence on 'Finalizado'. Works against AG Grid's center container.
+       With `pid_only`, only the row of `export_pid` is accepted (never "whatever is row 0")."""
     on_log("Esperando a que el archivo esté listo...")
 
     # Make sure we're on the right tab
     try:
-        tab_btn = page.locator("button#tabConsultasExportdas-tab, button[aria-controls='tabConsultasExportdas']").first
+        tab_btn = page.locator(EXPORTADAS_TAB_SELECTOR).first
         if await tab_btn.count():
             await tab_btn.click()
-            await asyncio.sleep(1.5)
+            await page.wait_for_selector(EXPORTS_FIRST_ROW_SELECTOR, state="visible", timeout=10000)
     except Exception:
         pass
 
-    # Give the back-end a moment to register the export entry
-    await asyncio.sleep(5)
+    # Locators used on every attempt, built once per call
+    refresh_btn = page.locator(REFRESH_GRID_BTN_SELECTOR).first
+    save_path = _build_download_path(tax_code, cuit_target, fecha_desde, fecha_hasta)
 
-    max_attempts = max_wait_minutes * 6
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_wait_minutes * 60
     attempt = 0
+    refreshes = 0  # Paces EXPORT_REFRESH_BACKOFF: only grid refreshes move it forward
 
-    while attempt < max_attempts:
-        attempt += 1
-        on_log(f"Intento {attempt}/{max_attempts}: buscando fila 0 y su ancla de descarga...")
+    # With the pid known, watch the grid's own data requests: a listing whose record for our
+    # export is finished ends the wait without the DOM poll or the next refresh. The export
+    # is listed (pending) as soon as it is registered, so being listed alone is not enough.
+    export_listed = asyncio.Event()
 
-        # 1) Refresh the grid (button present in your DOM)
+    async def _on_grid_response(response):
+        if (not export_pid or response.request.method != "GET"
+                or not EXPORT_API_RE.search(response.url) or "descarga" in response.url):
+            return
         try:
-            refresh_btn = page.locator("#btnRecargarTablaAplicativo, button#btnRecargarTablaAplicativo").first
-            if await refresh_btn.count():
-                await refresh_btn.click()
-                await asyncio.sleep(1.2)
-        except Exception as e:
-            on_log(f"  [DEBUG] refresh skip: {e}")
+            body = await response.text()
+            if export_pid in body and _export_record_finished(json.loads(body), export_pid):
+                export_listed.set()
+        except Exception:
+            pass  # Body not available (redirect, page closed) or not JSON
 
-        # 2) Resolve the <a download> for row 0 using many strategies (center container only)
-        anchor = await _resolve_first_row_download_anchor(page, on_log=on_log)
+    page.on("response", _on_grid_response)
 
-        if not anchor or (await anchor.count() == 0):
-            on_log("  [DEBUG] No anchor yet; sleeping 6s and retrying…")
-            await asyncio.sleep(6)
-            continue
+    # A download can also start on its own (a direct export that came after _export_csv
+    # stopped listening, or a late one from a timed-out click): take it whenever it lands
+    late_download = asyncio.ensure_future(page.wait_for_event("download", timeout=0))
+    late_download.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        while loop.time() < deadline:
+            attempt += 1
+            delay = EXPORT_REFRESH_BACKOFF[min(refreshes, len(EXPORT_REFRESH_BACKOFF) - 1)]
+            on_log(f"Intento {attempt}: buscando fila 0 y su ancla de descarga...")
+
+            # 0) With the export id known, try the download API directly (no grid, no click)
+            if export_pid:
+                file_path = await _download_export_by_pid(page, export_pid, cuit_target, save_path, on_log=on_log)
+                if file_path:
+                    return file_path
+
+            # 1) Watch the grid in-page until the export has its download link; if it doesn't
+            #    show up within the backoff delay, refresh the grid and go round again.
+            #    A grid listing with our export finished ends the wait early: the next
+            #    attempt starts with the direct download.
+            row_ready = asyncio.ensure_future(_export_row_ready(page, export_pid, timeout_s=delay, pid_only=pid_only))
+            listed = asyncio.ensure_future(export_listed.wait())
+            waiters = {row_ready, listed} if late_download.done() else {row_ready, listed, late_download}
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            listed.cancel()
+            if late_download in waiters and late_download.done() and late_download.exception() is None:
+                row_ready.cancel()
+                await _save_download(late_download.result(), save_path)
+                on_log(f"✓ Archivo descargado (evento de descarga): {save_path}")
+                return str(save_path)
+            if not row_ready.done():
+                row_ready.cancel()
+                export_listed.clear()
+                on_log("  [DEBUG] La grilla lista nuestra exportación como finalizada; reintentando descarga directa...")
+                continue
+            if not row_ready.result():
+                on_log(f"  [DEBUG] Exportación aún no lista ({delay}s); refrescando la grilla...")
+                refreshes += 1
+                try:
+                    if await refresh_btn.count():
+                        await refresh_btn.click()
+                        await page.wait_for_selector(EXPORTS_FIRST_ROW_SELECTOR, state="visible", timeout=5000)
+                except Exception as e:
+                    on_log(f"  [DEBUG] refresh skip: {e}")
+                continue
 
-        await anchor.scroll_into_view_if_needed()
+            # 2) Resolve the <a download> for row 0 using many strategies (center container only)
+            anchor = await _resolve_first_row_download_anchor(
+                page, on_log=on_log, export_pid=export_pid, pid_only=pid_only
+            )
 
-        # Always capture the href up front for non-click fallbacks
-        href = None
-        try:
-            href = await anchor.get_attribute("href")
-        except Exception:
-            pass
+            if not anchor or (await anchor.count() == 0):
+                on_log(f"  [DEBUG] No anchor yet; retrying in {delay}s…")
+                await asyncio.sleep(delay)
+                continue
 
-        # Build a friendly filename
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        desde_fmt = fecha_desde.replace("/", "")
-        hasta_fmt = fecha_hasta.replace("/", "")
-        filename = f"MR_{tax_code}_{cuit_target}_{desde_fmt}_{hasta_fmt}_{timestamp}.csv"
-        save_path = OUTPUT_DIR / filename
+            # Always capture the href up front for non-click fallbacks
+            href = None
+            try:
+                href = await anchor.get_attribute("href")
+            except Exception:
+                pass
 
-        # ---------------- Mechanism A: normal click with expect_download ----------------
-        try:
-            on_log("  [DEBUG] Mechanism A: expect_download + click()")
-            async with page.expect_download(timeout=30000) as di:
-                # Try a gentle click first
-                await anchor.click()
-            download = await di.value
-            await download.save_as(save_path)
-            on_log(f"✓ Archivo descargado (A): {save_path}")
-            return str(save_path)
-
-        except PWTimeout:
-            on_log("  [WARN] A1 timeout; will try A2 force-click")
+            # ---------------- Mechanism A: normal click with expect_download ----------------
             try:
+                on_log("  [DEBUG] Mechanism A: expect_download + click()")
                 async with page.expect_download(timeout=30000) as di:
-                    await anchor.click(force=True)
+                    # Try a gentle click first
+                    await anchor.click()
                 download = await di.value
-                await download.save_as(save_path)
-                on_log(f"✓ Archivo descargado (A2 force): {save_path}")
+                await _save_download(download, save_path)
+                on_log(f"✓ Archivo descargado (A): {save_path}")
                 return str(save_path)
+
+            except PWTimeout:
+                on_log("  [WARN] A1 timeout; will try A2 force-click")
+                try:
+                    async with page.expect_download(timeout=30000) as di:
+                        await anchor.click(force=True)
+                    download = await di.value
+                    await _save_download(download, save_path)
+                    on_log(f"✓ Archivo descargado (A2 force): {save_path}")
+                    return str(save_path)
+                except Exception as e:
+                    on_log(f"  [WARN] A2 failed: {e}")
+
             except Exception as e:
-                on_log(f"  [WARN] A2 failed: {e}")
+                on_log(f"  [WARN] Mechanism A failed: {e}")
 
-        except Exception as e:
-            on_log(f"  [WARN] Mechanism A failed: {e}")
+            # ---------------- Mechanism B: direct authenticated GET via context.request ----------------
+            # The HTML shows the anchor has a proper absolute/relative href and a download attribute.
+            if href:
+                try:
+                    url = urljoin(page.url, href)
+                    on_log("  [DEBUG] Mechanism B: HTTP GET through browser context")
+                    resp = await page.context.request.get(url)
+                    if not resp.ok:
+                        raise RuntimeError(f"HTTP {resp.status}")
+                    content = await resp.body()
+                    with open(save_path, "wb") as f:
+                        f.write(content)
+                    on_log(f"✓ Archivo descargado (B HTTP): {save_path}")
+                    return str(save_path)
+                except Exception as e:
+                    on_log(f"  [WARN] Mechanism B failed: {e}")
 
-        # ---------------- Mechanism B: direct authenticated GET via context.request ----------------
-        # The HTML shows the anchor has a proper absolute/relative href and a download attribute.
-        if href:
+            # ---------------- Mechanism C: programmatic click & new-tab handling (target='_blank') ----------------
+            # Your anchor uses target="_blank"; we catch a popup and then the download.
             try:
-                url = urljoin(page.url, href)
-                on_log("  [DEBUG] Mechanism B: HTTP GET through browser context")
-                resp = await page.context.request.get(url)
-                if not resp.ok:
-                    raise RuntimeError(f"HTTP {resp.status}")
-                content = await resp.body()
-                with open(save_path, "wb") as f:
-                    f.write(content)
-                on_log(f"✓ Archivo descargado (B HTTP): {save_path}")
-                return str(save_path)
+                on_log("  [DEBUG] Mechanism C: JS click + expect new page + expect download")
+                handle = await anchor.element_handle()
+                # Fire the click and wait for a popup (some deployments open a blank tab then trigger download)
+                async with page.context.expect_page(timeout=5000) as newp_info:
+                    await page.evaluate("(el) => el.click()", handle)
+                newp = await newp_info.value
+
+                # Either the download starts immediately, or the new tab renders then initiates download
+                try:
+                    async with newp.expect_download(timeout=30000) as di:
+                        # If the file opens as navigation, there may be nothing to click here
+                        pass
+                    dl = await di.value
+                    await _save_download(dl, save_path)
+                    on_log(f"✓ Archivo descargado (C new-tab): {save_path}")
+                    return str(save_path)
+                except PWTimeout:
+                    # Fallback inside C: if we *do* have the href, tell the new page to navigate to it
+                    if href:
+                        try:
+                            await newp.goto(urljoin(page.url, href), wait_until="domcontentloaded")
+                            async with newp.expect_download(timeout=15000) as di2:
+                                # Many servers trigger download immediately on GET
+                                pass
+                            dl2 = await di2.value
+                            await _save_download(dl2, save_path)
+                            on_log(f"✓ Archivo descargado (C2 nav): {save_path}")
+                            return str(save_path)
+                        except Exception as e2:
+                            on_log(f"  [WARN] Mechanism C2 failed: {e2}")
+                    # Close the useless tab so we can retry
+                    try:
+                        await newp.close()
+                    except Exception:
+                        pass
+
+            except PWTimeout:
+                on_log("  [DEBUG] No popup appeared; Mechanism C skipped.")
             except Exception as e:
-                on_log(f"  [WARN] Mechanism B failed: {e}")
+                on_log(f"  [WARN] Mechanism C failed: {e}")
+
+            # If we got here, none worked this round. Try again after the backoff delay.
+            await asyncio.sleep(delay)
+
+        raise PWTimeout(f"Archivo no listo/descargado después de {max_wait_minutes} minutos")
+    finally:
+        page.remove_listener("response", _on_grid_response)
+        late_download.cancel()
 
-        # ---------------- Mechanism C: programmatic click & new-tab handling (target='_blank') ----------------
 async def _process_single_operation(
     page, 
     tax_config, 
@@ -1025,18 +1986,37 @@ async def _process_single_operation(
     fecha_desde, 
     fecha_hasta,
     cuit_target,
-    on_log=print
+    on_log=print,
+    export_lock: Optional[asyncio.Lock] = None,
+    reuse_form: bool = False,
+    raise_errors: bool = False
 ):
     """Process a single operation (retención/percepción) for a tax type.
-    
+
+    Args:
+        export_lock: Shared lock when several pages run in parallel. Only one
+            page exports at a time; once the export pid is known the download
+            wait runs outside the lock (without a pid, row 0 of "Consultas
+            exportadas" is used, so the download stays inside it).
+        reuse_form: The page already ran another operation of this tax type;
+            if the form kept impuesto and dates, only the radio is changed.
+        raise_errors: Re-raise a failed export/download (after going back to the
+            form) instead of returning None, so callers can tell it from "sin datos".
+
     Returns:
-        Optional[str]: File path if successful, None if no results
+        Optional[str]: File path if successful, None if no results (or failed,
+        unless `raise_errors`)
     """
     on_log(f"  → {op_name}")
+    export_lock = export_lock or asyncio.Lock()
     
     try:
         # Fill the form
-        await _fill_consulta_form(page, tax_config.code, op_value, fecha_desde, fecha_hasta, on_log=on_log)
+        if reuse_form and await _form_keeps_values(page, tax_config.code, fecha_desde, fecha_hasta):
+            on_log("Formulario conservado: solo se cambia el tipo de operación")
+            await _set_operation_type(page, op_value, on_log=on_log)
+        else:
+            await _fill_consulta_form(page, tax_config.code, op_value, fecha_desde, fecha_hasta, on_log=on_log)
 
         # Click Consultar and check if there are results
         has_results = await _click_consultar(page, on_log=on_log)
@@ -1046,12 +2026,33 @@ async def _process_single_operation(
             return None
 
         # Si hay resultados, proceder con la exportación
-        await _export_csv(page, on_log=on_log)
-        await _handle_export_popup(page, on_log=on_log)
-        
-        file_path = await _wait_and_download_file(
-            page, tax_config.code, cuit_target, fecha_desde, fecha_hasta, on_log=on_log
-        )
+        async def wait_for_export(pid_only: bool):
+            # _export_csv already waited up to 12s for the modal: if it never showed,
+            # only give it a short grace instead of a second full wait
+            await _handle_export_popup(page, on_log=on_log, modal_timeout=12000 if modal_shown else 2000)
+            return await _wait_and_download_file(
+                page, tax_config.code, cuit_target, fecha_desde, fecha_hasta,
+                on_log=on_log, export_pid=export_pid, pid_only=pid_only
+            )
+
+        file_path = None
+        async with export_lock:
+            export_pid, download, modal_shown = await _export_csv(page, on_log=on_log)
+
+            if download is not None:
+                # Served immediately: no modal / "Consultas exportadas" round trip needed
+                save_path = _build_download_path(tax_config.code, cuit_target, fecha_desde, fecha_hasta)
+                await _save_download(download, save_path)
+                on_log(f"✓ Archivo descargado (directo): {save_path}")
+                file_path = str(save_path)
+            elif export_pid is None:
+                # Without the pid the file is taken from row 0: nobody else may export meanwhile
+                file_path = await wait_for_export(pid_only=False)
+
+        if download is None and export_pid is not None:
+            # The pid identifies this export, so the (long) wait for AFIP runs outside the
+            # lock: other tabs export their next consulta while this file is prepared
+            file_path = await wait_for_export(pid_only=True)
         
         on_log(f"  ✓ {op_name} completado")
         return file_path
@@ -1063,55 +2064,84 @@ async def _process_single_operation(
             await _navigate_to_nueva_consulta(page, on_log=on_log)
         except:
             pass
+        if raise_errors:
+            raise
         return None
 
-        # Your anchor uses target="_blank"; we catch a popup and then the download.
-        try:
-            on_log("  [DEBUG] Mechanism C: JS click + expect new page + expect download")
-            handle = await anchor.element_handle()
-            # Fire the click and wait for a popup (some deployments open a blank tab then trigger download)
-            async with page.context.expect_page(timeout=5000) as newp_info:
-                await page.evaluate("(el) => el.click()", handle)
-            newp = await newp_info.value
-
-            # Either the download starts immediately, or the new tab renders then initiates download
-            try:
-                async with newp.expect_download(timeout=30000) as di:
-                    # If the file opens as navigation, there may be nothing to click here
-                    pass
-                dl = await di.value
-                await dl.save_as(save_path)
-                on_log(f"✓ Archivo descargado (C new-tab): {save_path}")
-                return str(save_path)
-            except PWTimeout:
-                # Fallback inside C: if we *do* have the href, tell the new page to navigate to it
-                if href:
-                    try:
-                        await newp.goto(urljoin(page.url, href), wait_until="domcontentloaded")
-                        async with newp.expect_download(timeout=15000) as di2:
-                            # Many servers trigger download immediately on GET
-                            pass
-                        dl2 = await di2.value
-                        await dl2.save_as(save_path)
-                        on_log(f"✓ Archivo descargado (C2 nav): {save_path}")
-                        return str(save_path)
-                    except Exception as e2:
-                        on_log(f"  [WARN] Mechanism C2 failed: {e2}")
-                # Close the useless tab so we can retry
-                try:
-                    await newp.close()
-                except Exception:
-                    pass
+async def _open_sibling_page(context, mr_page, cuit_target: str, on_log=print, cuit_selected: bool = True):
+    """Open another tab on the already authenticated MIS RETENCIONES app.
 
-        except PWTimeout:
-            on_log("  [DEBUG] No popup appeared; Mechanism C skipped.")
-        except Exception as e:
-            on_log(f"  [WARN] Mechanism C failed: {e}")
+    Args:
+        cuit_selected: Whether `cuit_target` was selected on `mr_page`; the new tab
+            must then select it too, or it would query the default CUIT.
 
-        # If we got here, none worked this round. Try again after a short delay.
-        await asyncio.sleep(6)
+    Returns:
+        The new page with the consulta form ready, or None if the app did
+        not load in the new tab (the caller then runs sequentially).
+    """
+    page = await context.new_page()
+    try:
+        await _apply_viewport(page)
+        await page.goto(mr_page.url, wait_until="domcontentloaded")
+        await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=20000)
+        if not await _select_cuit_representado(page, cuit_target, on_log=on_log) and cuit_selected:
+            raise RuntimeError(f"no se pudo seleccionar el CUIT {cuit_target}")
+        return page
+    except Exception as e:
+        on_log(f"⚠ No se pudo abrir una pestaña adicional: {e}")
+        await page.close()
+        return None
 
-    raise PWTimeout(f"Archivo no listo/descargado después de {max_wait_minutes} minutos")
+async def _process_operations_parallel(
+    context,
+    mr_page,
+    tax_config,
+    operations,
+    fecha_desde,
+    fecha_hasta,
+    cuit_target,
+    on_log=print,
+    cuit_selected: bool = True
+):
+    """Run independent operations of one tax type on sibling tabs.
+
+    Form filling and "Consultar" overlap; export + download stay serialized
+    through a shared lock.
+
+    Returns:
+        List of file paths (None for operations without data) in the same
+        order as `operations`, or None if the extra tabs could not be opened.
+    """
+    pages = [mr_page]
+    for _ in operations[1:]:
+        sibling = await _open_sibling_page(context, mr_page, cuit_target, on_log=on_log,
+                                           cuit_selected=cuit_selected)
+        if sibling is None:
+            for extra in pages[1:]:
+                await extra.close()
+            return None
+        pages.append(sibling)
+
+    on_log(f"Procesando {len(operations)} operaciones en paralelo...")
+    export_lock = asyncio.Lock()
+    try:
+        return await asyncio.gather(*(
+            _process_single_operation(
+                page,
+                tax_config,
+                op_value,
+                op_name,
+                fecha_desde,
+                fecha_hasta,
+                cuit_target,
+                on_log=lambda msg, name=op_name: on_log(f"[{name}] {msg}"),
+                export_lock=export_lock
+            )
+            for page, (op_value, op_name) in zip(pages, operations)
+        ))
+    finally:
+        for extra in pages[1:]:
+            await extra.close()
 
 async def scrape_mis_retenciones(
     cuit_login: str,
@@ -1120,7 +2150,8 @@ async def scrape_mis_retenciones(
     tax_code: str,
     fecha_desde: str,
     fecha_hasta: str,
-    on_log=print
+    on_log=print,
+    headless: Optional[bool] = None
 ):
     """Main scraper function for Mis Retenciones.
 
@@ -1131,7 +2162,11 @@ async def scrape_mis_retenciones(
         tax_code: Código del impuesto (e.g., "IMP_217")
         fecha_desde: Fecha desde en formato dd/mm/yyyy
         fecha_hasta: Fecha hasta en formato dd/mm/yyyy
+        headless: Ocultar el navegador (None = según STUDIOAI_HEADLESS)
     """
+    if headless is None:
+        headless = HEADLESS_DEFAULT
+
     # Validate date range
     es_valido, mensaje = validar_rango_fecha(fecha_desde, fecha_hasta)
     if not es_valido:
@@ -1147,23 +2182,14 @@ async def scrape_mis_retenciones(
     on_log(f"Modo de operación: {tax_config.operation_mode}")
 
     on_log("Iniciando navegador...")
-    temp_profile = Path(tempfile.gettempdir()) / f"studioai_mr_{uuid.uuid4().hex[:8]}"
-    temp_profile.mkdir(parents=True, exist_ok=True)
-    temp_dir = str(temp_profile)
-    on_log(f"Usando profile temporal: {temp_dir}")
 
     downloaded_files = []
     context = None
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
     try:
-        async with async_playwright() as pw:
-            context = await pw.chromium.launch_persistent_context(
-                user_data_dir=temp_dir,
-                headless=False,
-                accept_downloads=True
-            )
-
+        # The browser stays open after the run: the next one skips the cold start (and login)
+        async with BROWSER_POOL.session(cuit_login, headless, on_log=on_log) as context:
             try:
                 # Start tracing
                 await context.tracing.start(screenshots=True, snapshots=True, sources=True)
@@ -1172,33 +2198,45 @@ async def scrape_mis_retenciones(
                 for p in context.pages:
                     await _apply_viewport(p)
 
-                # Login
-                portal = await _afip_login(context, cuit_login, clave, on_log=on_log)
+                # Login (skipped when a recent session can be restored)
+                portal = await _restore_session(context, cuit_login, on_log=on_log)
+                if portal is None:
+                    portal, logged_in = await _afip_login(context, cuit_login, clave, on_log=on_log)
+                    if logged_in:
+                        await _save_session(context, cuit_login, on_log=on_log)
 
                 # Open MIS RETENCIONES
                 mr_page = await _open_mis_retenciones(context, portal, on_log=on_log)
 
                 # Select CUIT target (representado)
-                await _select_cuit_representado(mr_page, cuit_target, on_log=on_log)
+                cuit_selected = await _select_cuit_representado(mr_page, cuit_target, on_log=on_log)
 
                 # Determine operation type(s) based on tax configuration
-                operations_to_run = []
-
-                if tax_config.operation_mode == "retencion":
-                    operations_to_run = [("1", "Retención")]
-                elif tax_config.operation_mode == "percepcion":
-                    operations_to_run = [("2", "Percepción")]
-                elif tax_config.operation_mode == "ambas":
-                    operations_to_run = [("0", "Retención y percepción")]
-                elif tax_config.operation_mode == "ambas_separadas":
-                    # Do 2 separate queries: first retención, then percepción
-                    operations_to_run = [("1", "Retención"), ("2", "Percepción")]
-                elif tax_config.operation_mode == "fecha_solo":
-                    # No operation type field for aduaneras
-                    operations_to_run = [(None, "Solo fecha")]
-
-                # Process each operation
-                for op_value, op_name in operations_to_run:
+                operations_to_run = OPERATIONS_BY_MODE[tax_config.operation_mode]
+
+                # Independent operations (ambas_separadas) run on sibling tabs
+                if len(operations_to_run) > 1:
+                    parallel_results = await _process_operations_parallel(
+                        context,
+                        mr_page,
+                        tax_config,
+                        operations_to_run,
+                        fecha_desde,
+                        fecha_hasta,
+                        cuit_target,
+                        on_log=on_log,
+                        cuit_selected=cuit_selected
+                    )
+                    if parallel_results is not None:
+                        for (_, op_name), file_path in zip(operations_to_run, parallel_results):
+                            if file_path:
+                                downloaded_files.append(file_path)
+                            else:
+                                on_log(f"⚠ No se descargó archivo para {op_name} (sin datos)")
+                        operations_to_run = []
+
+                # Process each operation (sequential fallback)
+                for op_idx, (op_value, op_name) in enumerate(operations_to_run):
                     on_log("")
                     on_log("=" * 60)
                     on_log(f"PROCESANDO: {tax_config.name} - {op_name}")
@@ -1212,7 +2250,8 @@ async def scrape_mis_retenciones(
                         fecha_desde,
                         fecha_hasta,
                         cuit_target,
-                        on_log=on_log
+                        on_log=on_log,
+                        reuse_form=op_idx > 0
                     )
                     
                     if file_path:
@@ -1249,20 +2288,99 @@ async def scrape_mis_retenciones(
                     on_log(f"⚠ No se pudo guardar tracing: {e}")
 
     finally:
-        try:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-            logger.info(f"Perfil temporal eliminado: {temp_dir}")
-        except Exception as e:
-            logger.warning(f"No se pudo eliminar perfil temporal: {e}")
+        _run_in_background(prune_profiles, PROFILES_KEEP, PROFILES_MAX_AGE, BROWSER_POOL.live_profile_dirs(),
+                           description="limpiar perfiles antiguos")
+
+async def _process_tax_type(
+    page,
+    tax_config,
+    fecha_desde,
+    fecha_hasta,
+    cuit_target,
+    on_log=print,
+    export_lock: Optional[asyncio.Lock] = None,
+    spare_page=None
+) -> List[str]:
+    """Run every operation of one tax type on `page`, leaving it on 'Nueva consulta'.
+
+    Args:
+        spare_page: A second idle tab; a tax type with two independent operations
+            (ambas_separadas) then runs them side by side, one per tab.
+
+    Returns:
+        List[str]: Paths of the downloaded files
+
+    Raises:
+        Exception: An operation failed (export or download); the tax type is not done.
+    """
+    operations = OPERATIONS_BY_MODE[tax_config.operation_mode]
+
+    if spare_page is not None and len(operations) == 2:
+        async def run_operation(op_page, op_value, op_name):
+            try:
+                return await _process_single_operation(
+                    op_page,
+                    tax_config,
+                    op_value,
+                    op_name,
+                    fecha_desde,
+                    fecha_hasta,
+                    cuit_target,
+                    on_log=lambda msg: on_log(f"[{op_name}] {msg}"),
+                    export_lock=export_lock,
+                    raise_errors=True
+                )
+            finally:
+                await _navigate_to_nueva_consulta(op_page, on_log=on_log)
+
+        on_log(f"Procesando {len(operations)} operaciones en paralelo...")
+        # Both operations finish before a failure is raised: the tabs go back to the pool after this
+        results = await asyncio.gather(*(
+            run_operation(op_page, op_value, op_name)
+            for op_page, (op_value, op_name) in zip((page, spare_page), operations)
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return [file_path for file_path in results if file_path]
+
+    files = []
+    for op_idx, (op_value, op_name) in enumerate(operations):
+        file_path = await _process_single_operation(
+            page,
+            tax_config,
+            op_value,
+            op_name,
+            fecha_desde,
+            fecha_hasta,
+            cuit_target,
+            on_log=on_log,
+            export_lock=export_lock,
+            reuse_form=op_idx > 0,
+            raise_errors=True
+        )
+        if file_path:
+            files.append(file_path)
+        await _navigate_to_nueva_consulta(page, on_log=on_log)
+    return files
+
+async def _close_other_pages(context, keep_page) -> None:
+    """Close every tab except `keep_page` (login/portal/blank tabs left over after opening the service)."""
+    for p in context.pages:
+        if p is not keep_page:
+            try:
+                await p.close()
+            except Exception:
+                pass
 
 async def _navigate_to_nueva_consulta(page, on_log=print):
     """Navigate back to 'Nueva consulta' tab after processing."""
     try:
         on_log("Navegando a 'Nueva consulta'...")
-        nueva_consulta_tab = page.locator("button#tabNuevaConsulta-tab, button[aria-controls='tabNuevaConsulta']").first
+        nueva_consulta_tab = page.locator(NUEVA_CONSULTA_TAB_SELECTOR).first
         await nueva_consulta_tab.wait_for(state="visible", timeout=10000)
         await nueva_consulta_tab.click()
-        await asyncio.sleep(2)
+        await page.wait_for_selector(FORM_READY_SELECTOR, state="visible", timeout=10000)
         on_log("✓ Navegado a 'Nueva consulta'")
     except Exception as e:
         on_log(f"⚠ Error al navegar a 'Nueva consulta': {e}")
@@ -1274,7 +2392,8 @@ async def scrape_mis_retenciones_batch(
     fecha_desde: str,
     fecha_hasta: str,
     resume_session_id: Optional[str] = None,
-    on_log=print
+    on_log=print,
+    headless: bool = True
 ):
     """Batch scraper that processes all 14 tax types automatically.
 
@@ -1285,6 +2404,7 @@ async def scrape_mis_retenciones_batch(
         fecha_desde: Fecha desde en formato dd/mm/yyyy
         fecha_hasta: Fecha hasta en formato dd/mm/yyyy
         resume_session_id: Optional session ID to resume from checkpoint
+        headless: Ocultar el navegador (por defecto sí: el batch corre desatendido)
     """
     # Validate date range
     es_valido, mensaje = validar_rango_fecha(fecha_desde, fecha_hasta)
@@ -1297,6 +2417,8 @@ async def scrape_mis_retenciones_batch(
     if resume_session_id:
         progress = load_checkpoint(resume_session_id)
         if progress:
+            # Whatever was in flight when the session stopped is simply pending again
+            progress.in_flight_tax_codes = []
             on_log(f"📂 Reanudando desde checkpoint: {resume_session_id}")
             on_log(f"Completados: {len(progress.completed_tax_codes)}/{len(TAX_TYPES)}")
         else:
@@ -1313,7 +2435,7 @@ async def scrape_mis_retenciones_batch(
             fecha_hasta=fecha_hasta,
             started_at=now_ts(),
             completed_tax_codes=[],
-            current_tax_code=None,
+            in_flight_tax_codes=[],
             all_downloaded_files=[],
             status="in_progress",
             last_updated=now_ts()
@@ -1321,6 +2443,9 @@ async def scrape_mis_retenciones_batch(
         save_checkpoint(progress)
         on_log(f"🆕 Nueva sesión batch: {session_id}")
 
+    # Progress updates during the run are coalesced and written off the event loop
+    checkpoints = CheckpointWriter(progress)
+
     on_log("")
     on_log("=" * 70)
     on_log(f"MODO BATCH: Procesando {len(TAX_TYPES)} tipos de impuestos")
@@ -1328,20 +2453,12 @@ async def scrape_mis_retenciones_batch(
     on_log("")
 
     on_log("Iniciando navegador...")
-    temp_profile = Path(tempfile.gettempdir()) / f"studioai_mr_batch_{progress.session_id}"
-    temp_profile.mkdir(parents=True, exist_ok=True)
-    temp_dir = str(temp_profile)
-
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
     try:
-        async with async_playwright() as pw:
-            context = await pw.chromium.launch_persistent_context(
-                user_data_dir=temp_dir,
-                headless=False,
-                accept_downloads=True
-            )
-
+        # Same persistent per-CUIT profile as single mode: a resumed batch starts with a warm
+        # cache and session instead of a cold temporary profile
+        async with BROWSER_POOL.session(cuit_login, headless, on_log=on_log) as context:
             try:
                 # Start tracing
                 await context.tracing.start(screenshots=True, snapshots=True, sources=True)
@@ -1350,90 +2467,124 @@ async def scrape_mis_retenciones_batch(
                 for p in context.pages:
                     await _apply_viewport(p)
 
-                # Login
-                portal = await _afip_login(context, cuit_login, clave, on_log=on_log)
+                # Login (a resumed or repeated batch reuses the saved session when still valid)
+                portal = await _restore_session(context, cuit_login, on_log=on_log)
+                if portal is None:
+                    portal, logged_in = await _afip_login(context, cuit_login, clave, on_log=on_log)
+                    if logged_in:
+                        await _save_session(context, cuit_login, on_log=on_log)
 
                 # Open MIS RETENCIONES
                 mr_page = await _open_mis_retenciones(context, portal, on_log=on_log)
 
                 # Select CUIT target (representado)
-                await _select_cuit_representado(mr_page, cuit_target, on_log=on_log)
+                cuit_selected = await _select_cuit_representado(mr_page, cuit_target, on_log=on_log)
+
+                # The whole batch runs on this one authenticated tab; drop the rest
+                await _close_other_pages(context, mr_page)
 
-                # Process each tax type
+                # Tax types still to do (skip those already completed)
+                pending = []
+                completed = frozenset(progress.completed_tax_codes)
                 for idx, tax_config in enumerate(TAX_TYPES, 1):
-                    # Skip if already completed
-                    if tax_config.code in progress.completed_tax_codes:
+                    if tax_config.code in completed:
                         on_log(f"⏭️  [{idx}/{len(TAX_TYPES)}] Saltando {tax_config.name} (ya completado)")
-                        continue
-
-                    on_log("")
-                    on_log("=" * 70)
-                    on_log(f"📋 [{idx}/{len(TAX_TYPES)}] PROCESANDO: {tax_config.name}")
-                    on_log(f"Categoría: {tax_config.category}")
-                    on_log(f"Modo: {tax_config.operation_mode}")
-                    on_log("=" * 70)
-
-                    # Update current tax in progress
-                    progress.current_tax_code = tax_config.code
-                    save_checkpoint(progress)
-
-                    # Determine operation type(s) based on tax configuration
-                    operations_to_run = []
-
-                    if tax_config.operation_mode == "retencion":
-                        operations_to_run = [("1", "Retención")]
-                    elif tax_config.operation_mode == "percepcion":
-                        operations_to_run = [("2", "Percepción")]
-                    elif tax_config.operation_mode == "ambas":
-                        operations_to_run = [("0", "Retención y percepción")]
-                    elif tax_config.operation_mode == "ambas_separadas":
-                        # Do 2 separate queries: first retención, then percepción
-                        operations_to_run = [("1", "Retención"), ("2", "Percepción")]
-                    elif tax_config.operation_mode == "fecha_solo":
-                        # No operation type field for aduaneras
-                        operations_to_run = [(None, "Solo fecha")]
-
-                    # Process each operation for this tax type
-                    for op_value, op_name in operations_to_run:
-                        file_path = await _process_single_operation(
-                            mr_page,
+                    else:
+                        pending.append((idx, tax_config))
+
+                # Page pool: the main tab plus sibling tabs on the same authenticated context
+                page_pool: asyncio.Queue = asyncio.Queue()
+                page_pool.put_nowait(mr_page)
+                siblings = []
+                for _ in range(min(BATCH_CONCURRENCY, len(pending)) - 1):
+                    sibling = await _open_sibling_page(context, mr_page, cuit_target, on_log=on_log,
+                                                       cuit_selected=cuit_selected)
+                    if sibling is None:
+                        break
+                    siblings.append(sibling)
+                    page_pool.put_nowait(sibling)
+                if siblings:
+                    on_log(f"Procesando hasta {len(siblings) + 1} tipos de impuestos en paralelo...")
+
+                export_lock = asyncio.Lock()
+
+                async def run_tax_type(idx, tax_config):
+                    page = await page_pool.get()
+                    # Two-operation tax types borrow a second tab when one is idle right now
+                    spare_page = None
+                    if len(OPERATIONS_BY_MODE[tax_config.operation_mode]) > 1 and not page_pool.empty():
+                        spare_page = page_pool.get_nowait()
+                    tax_log = lambda msg: on_log(f"[{tax_config.code}] {msg}")
+                    try:
+                        tax_log("=" * 70)
+                        tax_log(f"📋 [{idx}/{len(TAX_TYPES)}] PROCESANDO: {tax_config.name}")
+                        tax_log(f"Categoría: {tax_config.category}")
+                        tax_log(f"Modo: {tax_config.operation_mode}")
+                        tax_log("=" * 70)
+
+                        # Record it as in flight (other tax types may be running next to it)
+                        progress.in_flight_tax_codes.append(tax_config.code)
+                        checkpoints.schedule()
+
+                        files = await _process_tax_type(
+                            page,
                             tax_config,
-                            op_value,
-                            op_name,
                             fecha_desde,
                             fecha_hasta,
                             cuit_target,
-                            on_log=on_log
+                            on_log=tax_log,
+                            export_lock=export_lock,
+                            spare_page=spare_page
                         )
-                        
-                        if file_path:
-                            progress.all_downloaded_files.append(file_path)
-                            save_checkpoint(progress)
-                        
-                        # Navigate back to "Nueva consulta" for next operation/tax type
-                        # (only if not the last operation AND not last tax type)
-                        is_last_op = (op_value == operations_to_run[-1][0])
-                        is_last_tax = (idx == len(TAX_TYPES))
-                        
-                        if not (is_last_op and is_last_tax):
-                            await _navigate_to_nueva_consulta(mr_page, on_log=on_log)
 
-                    # Mark this tax type as completed
-                    progress.completed_tax_codes.append(tax_config.code)
-                    progress.current_tax_code = None
-                    save_checkpoint(progress)
-
-                    on_log(f"✅ [{idx}/{len(TAX_TYPES)}] {tax_config.name} COMPLETADO")
-                    on_log(f"Progreso general: {len(progress.completed_tax_codes)}/{len(TAX_TYPES)}")
+                        # Mark this tax type as completed
+                        progress.all_downloaded_files.extend(files)
+                        progress.completed_tax_codes.append(tax_config.code)
+                        progress.in_flight_tax_codes.remove(tax_config.code)
+                        checkpoints.schedule()
+
+                        tax_log(f"✅ [{idx}/{len(TAX_TYPES)}] {tax_config.name} COMPLETADO")
+                        on_log(f"Progreso general: {len(progress.completed_tax_codes)}/{len(TAX_TYPES)}")
+                    finally:
+                        if tax_config.code in progress.in_flight_tax_codes:  # Failed: pending again
+                            progress.in_flight_tax_codes.remove(tax_config.code)
+                            checkpoints.schedule()
+                        page_pool.put_nowait(page)
+                        if spare_page is not None:
+                            page_pool.put_nowait(spare_page)
+
+                # One failed tax type does not abort the others
+                try:
+                    results = await asyncio.gather(
+                        *(run_tax_type(idx, tax_config) for idx, tax_config in pending),
+                        return_exceptions=True
+                    )
+                finally:
+                    for sibling in siblings:
+                        await sibling.close()
+
+                failed = []
+                for (idx, tax_config), result in zip(pending, results):
+                    if isinstance(result, Exception):
+                        failed.append(tax_config.code)
+                        on_log(f"❌ [{idx}/{len(TAX_TYPES)}] {tax_config.name} falló: {result}")
+
+                if failed:
+                    # Leave the session resumable: only the failed tax types remain pending
+                    await checkpoints.flush()
+                    on_log("")
+                    on_log(f"⚠ Batch terminado con {len(failed)} tipo(s) pendiente(s): {', '.join(failed)}")
+                    on_log("  → Use 'Reanudar última sesión' para reintentarlos")
+                else:
+                    # All completed
+                    progress.status = "completed"
+                    await checkpoints.flush()
 
-                # All completed
-                progress.status = "completed"
-                save_checkpoint(progress)
+                    on_log("")
+                    on_log("=" * 70)
+                    on_log("🎉 BATCH PROCESS COMPLETADO 🎉")
+                    on_log("=" * 70)
 
-                on_log("")
-                on_log("=" * 70)
-                on_log("🎉 BATCH PROCESS COMPLETADO 🎉")
-                on_log("=" * 70)
                 on_log(f"Total de archivos descargados: {len(progress.all_downloaded_files)}")
                 on_log(f"Tipos de impuestos procesados: {len(progress.completed_tax_codes)}")
                 on_log("")
@@ -1458,29 +2609,70 @@ async def scrape_mis_retenciones_batch(
                 except Exception as e:
                     on_log(f"⚠ No se pudo guardar tracing: {e}")
 
+    except asyncio.CancelledError:
+        # Window closed mid-run: the writer task is being cancelled too, so persist the
+        # latest progress here (still in_progress: resumable without redoing finished taxes)
+        await asyncio.to_thread(save_checkpoint, progress, True)
+        on_log("⚠ Batch cancelado; progreso guardado para reanudar")
+        raise
+
     except Exception as e:
         progress.status = "error"
-        save_checkpoint(progress)
+        await checkpoints.flush()
         on_log(f"❌ Error en batch process: {e}")
         raise
 
     finally:
-        try:
-            if progress.status == "completed":
-                # Clean up temp profile only if completed successfully
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                logger.info(f"Perfil temporal eliminado: {temp_dir}")
-            else:
-                on_log(f"⚠ Perfil temporal conservado para posible reanudación: {temp_dir}")
-        except Exception as e:
-            logger.warning(f"No se pudo eliminar perfil temporal: {e}")
+        _run_in_background(prune_profiles, PROFILES_KEEP, PROFILES_MAX_AGE, BROWSER_POOL.live_profile_dirs(),
+                           description="limpiar perfiles antiguos")
 
 # ---------------- Tkinter GUI ---------------- #
 
+async def _shutdown_loop_tasks(timeout: float = 5, cleanup_timeout: float = 60) -> None:
+    """Cancel the running job, let background cleanups finish, then close the browser pool."""
+    tasks = [t for t in asyncio.all_tasks()
+             if t is not asyncio.current_task() and t not in _background_tasks]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=timeout)
+    # Cleanups (a profile rmtree, possibly just started by the cancelled job's finally) run in
+    # worker threads that die with the process: don't stop the loop halfway through one
+    if _background_tasks:
+        await asyncio.wait(list(_background_tasks), timeout=cleanup_timeout)
+    try:
+        await asyncio.wait_for(BROWSER_POOL.close(), timeout)
+    except Exception as e:
+        logger.warning(f"No se pudo cerrar el navegador: {e}")  # A dead browser must not block closing
+
+# Control states of the window (see App._set_state)
+UI_IDLE_NO_CKPT = "idle_no_ckpt"
+UI_IDLE_WITH_CKPT = "idle_with_ckpt"
+UI_RUNNING_SINGLE = "running_single"
+UI_RUNNING_BATCH = "running_batch"
+
+_UI_BUTTON_TEXT = {
+    UI_RUNNING_SINGLE: "Procesando...",
+    UI_RUNNING_BATCH: "Procesando Batch...",
+}
+
 class App(tk.Tk):
     def __init__(self):
         super().__init__()
         self.title("AFIP - MIS RETENCIONES")
+
+        # One long-lived event loop for every run, instead of a thread + asyncio.run per click
+        self._loop = new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # Pending log lines, flushed to the Text widget at ~60Hz (one redraw per batch).
+        # Created first so log_line works before the log widget exists (check_for_checkpoint).
+        self._log_queue: deque = deque()
+        # (monotonic time, result) of the last find_latest_checkpoint()
+        self._ckpt_cache: Tuple[float, Optional[BatchProgress]] = (0.0, None)
+        self.after(LOG_DRAIN_MS, self._drain_log)
         self.resizable(False, False)
 
         frm = ttk.Frame(self, padding="10")
@@ -1507,11 +2699,7 @@ class App(tk.Tk):
         self.tax_combo = ttk.Combobox(frm, textvariable=self.tax_var, width=40, state="readonly")
 
         # Populate dropdown with tax types grouped by category
-        tax_options = []
-        for tax in TAX_TYPES:
-            tax_options.append(f"{tax.name} [{tax.category}]")
-
-        self.tax_combo['values'] = tax_options
+        self.tax_combo['values'] = list(_TAX_BY_DISPLAY)
         self.tax_combo.grid(row=3, column=1, padx=8, pady=6, columnspan=2)
 
         # Fecha desde
@@ -1538,7 +2726,16 @@ class App(tk.Tk):
             variable=self.batch_mode_var,
             command=self.on_batch_mode_changed
         )
-        self.batch_checkbox.grid(row=6, column=0, columnspan=3, sticky="w", padx=8, pady=(10, 6))
+        self.batch_checkbox.grid(row=6, column=0, columnspan=2, sticky="w", padx=8, pady=(10, 6))
+
+        # Browser window: hidden unless the user wants to watch the run
+        self.show_browser_var = tk.BooleanVar(value=False)
+        self.show_browser_checkbox = ttk.Checkbutton(
+            frm,
+            text="Mostrar navegador",
+            variable=self.show_browser_var
+        )
+        self.show_browser_checkbox.grid(row=6, column=2, sticky="w", padx=8, pady=(10, 6))
 
         # Start button
         self.btn = ttk.Button(frm, text="Iniciar", command=self.on_start)
@@ -1547,9 +2744,9 @@ class App(tk.Tk):
         # Resume button
         self.btn_resume = ttk.Button(frm, text="Reanudar última sesión", command=self.on_resume)
         self.btn_resume.grid(row=7, column=2, sticky="ew", padx=8, pady=6)
-        self.btn_resume.config(state="disabled")  # Disabled by default
 
-        # Check if there's a checkpoint to resume
+        # Check if there's a checkpoint to resume (sets the initial control state)
+        self._idle_state = UI_IDLE_NO_CKPT
         self.check_for_checkpoint()
 
         # Log area
@@ -1561,41 +2758,127 @@ class App(tk.Tk):
         self.log.config(yscrollcommand=scroll.set)
 
     def log_line(self, msg: str):
-        self.log.configure(state="normal")
+        """Queue a log line; safe to call from the scraper's loop thread."""
         ts = datetime.now().strftime("%H:%M:%S")
-        self.log.insert("end", f"[{ts}] {msg}\n")
-        self.log.see("end")
-        self.log.configure(state="disabled")
+        self._log_queue.append(f"[{ts}] {msg}\n")
+
+    def _drain_log(self):
+        """Write up to LOG_DRAIN_MAX queued lines in a single insert and reschedule."""
+        if self._log_queue:
+            lines = []
+            while self._log_queue and len(lines) < LOG_DRAIN_MAX:
+                lines.append(self._log_queue.popleft())
+            self.log.configure(state="normal")
+            self.log.insert("end", "".join(lines))
+            self.log.see("end")
+            self.log.configure(state="disabled")
+        self.after(LOG_DRAIN_MS, self._drain_log)
+
+    def _ui(self, fn, *args, **kwargs):
+        """Run a widget update on the Tk thread, at idle time (the worker's way to touch the UI)."""
+        self.after_idle(lambda: fn(*args, **kwargs))
+
+    def _dialog(self, title: str, text: str) -> Tuple[tk.Toplevel, ttk.Frame]:
+        """Build a Toplevel with `text`; returns it and the frame for its buttons."""
+        top = tk.Toplevel(self)
+        top.title(title)
+        top.transient(self)
+        top.resizable(False, False)
+        ttk.Label(top, text=text, padding=12, justify="left").pack()
+        buttons = ttk.Frame(top, padding=(12, 0, 12, 12))
+        buttons.pack()
+        return top, buttons
+
+    def _confirm(self, title: str, text: str, on_yes, on_no=None):
+        """Yes/No dialog answered through callbacks.
+
+        Unlike messagebox.askyesno it runs no nested event loop, so the log keeps draining.
+        """
+        top, buttons = self._dialog(title, text)
+
+        def answer(callback):
+            top.destroy()
+            if callback:
+                callback()
+
+        ttk.Button(buttons, text="Sí", command=lambda: answer(on_yes)).pack(side="left", padx=4)
+        ttk.Button(buttons, text="No", command=lambda: answer(on_no)).pack(side="left", padx=4)
+        top.protocol("WM_DELETE_WINDOW", lambda: answer(on_no))
+        # X11 refuses a grab on a window that is not mapped yet ("grab failed: window not viewable")
+        # (children share the Toplevel's bindtag, so only react to the Toplevel's own <Map>)
+        top.bind("<Map>", lambda ev: top.grab_set() if ev.widget is top else None, add="+")
+
+    def _notify(self, title: str, text: str):
+        """Non-modal message window (replaces messagebox.showinfo/showerror for run results)."""
+        top, buttons = self._dialog(title, text)
+        ttk.Button(buttons, text="OK", command=top.destroy).pack()
+
+    def _set_state(self, state: str):
+        """Configure every control for `state` in one pass (one redraw per transition)."""
+        running = state in (UI_RUNNING_SINGLE, UI_RUNNING_BATCH)
+        if not running:
+            self._idle_state = state
+        enabled = "disabled" if running else "normal"
+        self.btn.configure(state=enabled, text=_UI_BUTTON_TEXT.get(state, "Iniciar"))
+        self.btn_resume.configure(state="normal" if state == UI_IDLE_WITH_CKPT else "disabled")
+        self.batch_checkbox.configure(state=enabled)
+        self.show_browser_checkbox.configure(state=enabled)
+        # Batch mode runs every tax type: the dropdown only applies to single mode
+        self.tax_combo.configure(state="disabled" if running or self.batch_mode_var.get() else "readonly")
         self.update_idletasks()
 
     def on_batch_mode_changed(self):
         """Handle batch mode checkbox change."""
+        self._set_state(self._idle_state)
         if self.batch_mode_var.get():
-            # Batch mode: disable tax type dropdown
-            self.tax_combo.config(state="disabled")
             self.log_line("Modo Batch activado: Se procesarán todos los tipos de impuestos")
         else:
-            # Single mode: enable tax type dropdown
-            self.tax_combo.config(state="readonly")
             self.log_line("Modo Single activado: Seleccione un tipo de impuesto")
 
+    def _latest_checkpoint_cached(self, ttl: float = CHECKPOINT_CACHE_TTL) -> Optional[BatchProgress]:
+        """find_latest_checkpoint(), reusing the result for `ttl` seconds."""
+        ts, latest = self._ckpt_cache
+        if ts and time.monotonic() - ts < ttl:
+            return latest
+        latest = find_latest_checkpoint()
+        self._ckpt_cache = (time.monotonic(), latest)
+        return latest
+
+    def _invalidate_ckpt_cache(self) -> None:
+        """Forget the cached checkpoint (a batch just wrote a new one)."""
+        self._ckpt_cache = (0.0, None)
+
     def check_for_checkpoint(self):
         """Check if there's a checkpoint file to resume from."""
-        latest = find_latest_checkpoint()
-        if latest:
-            self.btn_resume.config(state="normal")
+        latest = self._latest_checkpoint_cached()
+        if latest and checkpoint_is_stale(latest):
+            self._set_state(UI_IDLE_NO_CKPT)
+            self.log_line(f"⚠ Sesión interrumpida {latest.session_id} expirada "
+                          f"(iniciada {latest.started_at}, más de {CHECKPOINT_STALE_HOURS}h): no se ofrece reanudar")
+        elif latest:
+            self._set_state(UI_IDLE_WITH_CKPT)
             self.log_line(f"Sesión interrumpida encontrada: {latest.session_id}")
             self.log_line(f"Progreso: {len(latest.completed_tax_codes)}/{len(TAX_TYPES)} completados")
         else:
-            self.btn_resume.config(state="disabled")
+            self._set_state(UI_IDLE_NO_CKPT)
 
     def on_resume(self):
         """Resume from the latest checkpoint."""
-        latest = find_latest_checkpoint()
+        latest = self._latest_checkpoint_cached()
         if not latest:
             messagebox.showerror("Error", "No se encontró ninguna sesión para reanudar.")
             return
 
+        # Every tax type already done (e.g. interrupted right after the last one):
+        # don't launch the browser and log in for nothing
+        if ALL_TAX_CODES.issubset(latest.completed_tax_codes):
+            delete_checkpoint(latest.session_id)
+            self.log_line(f"Sesión {latest.session_id} ya completa: checkpoint eliminado")
+            self._notify("Nada que hacer", "La sesión ya está completa.")
+            self._invalidate_ckpt_cache()
+            self.check_for_checkpoint()
+            return
+
         # Populate fields from checkpoint
         self.e_cuit.delete(0, tk.END)
         self.e_cuit.insert(0, latest.cuit_login)
@@ -1613,19 +2896,20 @@ class App(tk.Tk):
         self.batch_mode_var.set(True)
         self.on_batch_mode_changed()
 
+        def resume():
+            self.log_line(f"Reanudando sesión: {latest.session_id}")
+            self.start_batch_worker(resume_session_id=latest.session_id)
+
         # Ask for confirmation
-        confirm = messagebox.askyesno(
+        self._confirm(
             "Reanudar sesión",
             f"Se reanudará la sesión {latest.session_id}\n\n"
             f"Iniciada: {latest.started_at}\n"
             f"Progreso: {len(latest.completed_tax_codes)}/{len(TAX_TYPES)} completados\n\n"
-            f"¿Continuar?"
+            f"¿Continuar?",
+            on_yes=resume
         )
 
-        if confirm:
-            self.log_line(f"Reanudando sesión: {latest.session_id}")
-            self.start_batch_worker(resume_session_id=latest.session_id)
-
     def validate(self) -> Optional[Tuple[str, str, str, Optional[str], str, str]]:
         cuit = self.e_cuit.get().strip()
         clave = self.e_clave.get().strip()
@@ -1661,11 +2945,7 @@ class App(tk.Tk):
 
             # Extract tax code from selection
             # Format: "217 - SICORE-IMPTO.A LAS GANANCIAS [Impositivas]"
-            # We need to find which TAX_TYPE matches this
-            for tax in TAX_TYPES:
-                if f"{tax.name} [{tax.category}]" == tax_selection:
-                    tax_code = tax.code
-                    break
+            tax_code = _TAX_BY_DISPLAY.get(tax_selection)
 
             if not tax_code:
                 messagebox.showerror("Validación", "Error al identificar el tipo de impuesto.")
@@ -1682,104 +2962,122 @@ class App(tk.Tk):
 
         # Check if batch mode
         if self.batch_mode_var.get():
-            self.start_batch_worker()
+            self.start_batch_worker(data=data)
         else:
             self.start_single_worker(cuit, clave, cuit_target, tax_code, fecha_desde, fecha_hasta)
 
     def start_single_worker(self, cuit, clave, cuit_target, tax_code, fecha_desde, fecha_hasta):
         """Start worker for single tax type processing."""
-        self.btn.configure(state="disabled", text="Procesando...")
-        self.btn_resume.configure(state="disabled")
+        self._set_state(UI_RUNNING_SINGLE)
         self.log_line("✓ Validación OK. Arrancando modo single...")
+        headless = not self.show_browser_var.get()
 
-        def worker():
+        async def worker():
             try:
-                def _on_log(msg):
-                    self.after(0, self.log_line, msg)
-
-                result = asyncio.run(scrape_mis_retenciones(
-                    cuit, clave, cuit_target, tax_code, fecha_desde, fecha_hasta, on_log=_on_log
-                ))
-
-                files_msg = "\n".join([f"- {f}" for f in result['files']])
-
-                self.after(0, lambda: messagebox.showinfo(
-                    "Listo",
+                # log_line only appends to the drained deque (thread-safe): no Tk call per message
+                result = await scrape_mis_retenciones(
+                    cuit, clave, cuit_target, tax_code, fecha_desde, fecha_hasta, on_log=self.log_line,
+                    headless=headless
+                )
+
+                files_msg = "\n".join(f"- {f}" for f in result['files'])
+                # Built here, on the loop thread: the Tk thread only shows it
+                msg = (
                     f"Proceso finalizado.\n\n"
                     f"Tipo de impuesto: {result['tax_type']}\n\n"
                     f"Archivos descargados:\n{files_msg}"
-                ))
+                )
+                self._ui(self._notify, "Listo", msg)
             except Exception as e:
                 err_msg = f"{e}"
-                import traceback
                 full_trace = traceback.format_exc()
-                self.after(0, lambda m=err_msg: messagebox.showerror("Error", m))
-                self.after(0, lambda t=full_trace: self.log_line(f"ERROR COMPLETO:\n{t}"))
+                self._ui(self._notify, "Error", err_msg)
+                self.log_line(f"ERROR COMPLETO:\n{full_trace}")
             finally:
-                self.after(0, lambda: self.btn.configure(state="normal", text="Iniciar"))
-                self.after(0, lambda: self.btn_resume.configure(state="normal"))
+                self._ui(self._reset_ui_after_run)
 
-        threading.Thread(target=worker, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(worker(), self._loop)
 
-    def start_batch_worker(self, resume_session_id: Optional[str] = None):
-        """Start worker for batch processing all tax types."""
-        data = self.validate()
-        if not data:
-            return
+    def start_batch_worker(self, data=None, resume_session_id: Optional[str] = None):
+        """Start worker for batch processing all tax types.
+
+        Args:
+            data: Result of validate(), when the caller already validated the form.
+            resume_session_id: Checkpoint session to resume (the form is validated here).
+        """
+        if data is None:
+            data = self.validate()
+            if not data:
+                return
 
         cuit, clave, cuit_target, _, fecha_desde, fecha_hasta = data
 
-        self.btn.configure(state="disabled", text="Procesando Batch...")
-        self.btn_resume.configure(state="disabled")
-        self.batch_checkbox.configure(state="disabled")
+        self._set_state(UI_RUNNING_BATCH)
 
         if not resume_session_id:
             self.log_line("✓ Validación OK. Arrancando modo batch...")
         else:
             self.log_line(f"✓ Reanudando sesión batch: {resume_session_id}")
+        headless = not self.show_browser_var.get()
 
-        def worker():
+        async def worker():
             try:
-                def _on_log(msg):
-                    self.after(0, self.log_line, msg)
-
-                result = asyncio.run(scrape_mis_retenciones_batch(
+                # log_line only appends to the drained deque (thread-safe): no Tk call per message
+                result = await scrape_mis_retenciones_batch(
                     cuit, clave, cuit_target, fecha_desde, fecha_hasta,
                     resume_session_id=resume_session_id,
-                    on_log=_on_log
-                ))
+                    on_log=self.log_line,
+                    headless=headless
+                )
 
                 files_count = len(result['files'])
                 completed = result['completed_count']
                 total = result['total_count']
 
-                self.after(0, lambda: messagebox.showinfo(
-                    "Batch Completado",
+                msg = (
                     f"Proceso batch finalizado.\n\n"
                     f"Tipos procesados: {completed}/{total}\n"
                     f"Total archivos: {files_count}\n\n"
                     f"Ver log para detalles."
-                ))
-
-                # Re-check for checkpoints
-                self.after(0, self.check_for_checkpoint)
+                )
+                self._ui(self._notify, "Batch Completado", msg)
 
             except Exception as e:
                 err_msg = f"{e}"
-                import traceback
                 full_trace = traceback.format_exc()
-                self.after(0, lambda m=err_msg: messagebox.showerror("Error", m))
-                self.after(0, lambda t=full_trace: self.log_line(f"ERROR COMPLETO:\n{t}"))
-
-                # Re-check for checkpoints (in case of error, might be resumable)
-                self.after(0, self.check_for_checkpoint)
+                self._ui(self._notify, "Error", err_msg)
+                self.log_line(f"ERROR COMPLETO:\n{full_trace}")
 
             finally:
-                self.after(0, lambda: self.btn.configure(state="normal", text="Iniciar"))
-                self.after(0, lambda: self.batch_checkbox.configure(state="normal"))
-                self.after(0, lambda: self.btn_resume.configure(state="normal"))
+                self._ui(self._reset_ui_after_run, batch=True)
 
-        threading.Thread(target=worker, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(worker(), self._loop)
+
+    def _reset_ui_after_run(self, batch: bool = False):
+        """Re-enable the controls a run disabled (one Tk callback per finished run)."""
+        if batch:
+            # The batch wrote a new checkpoint: re-read it (after an error it may be resumable)
+            self._invalidate_ckpt_cache()
+            self.check_for_checkpoint()
+        else:
+            self._set_state(self._idle_state)
+
+    def on_close(self):
+        """Cancel the running job and close the browsers on the worker loop, then destroy the window.
+
+        Nothing here waits on the loop: the window is hidden at once and destroyed
+        from an after() poll when the shutdown finishes.
+        """
+        self.withdraw()
+        shutdown = asyncio.run_coroutine_threadsafe(_shutdown_loop_tasks(), self._loop)
+        self._destroy_when_done(shutdown)
+
+    def _destroy_when_done(self, shutdown):
+        if not shutdown.done():
+            self.after(100, self._destroy_when_done, shutdown)
+            return
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self.destroy()
 
 def main():
     app = App()